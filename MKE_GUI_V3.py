@@ -1,6 +1,9 @@
 import sys
+import time
+# Taken before the imports below, to measure the time to the first window
+STARTED = time.perf_counter()
+import threading
 import numpy as np
-import matplotlib.pyplot as plt
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -15,37 +18,39 @@ from PyQt5.QtWidgets import (
     QFormLayout,
     QMessageBox,
     QAction,
-    QMenu
+    QTableWidget,
+    QTableWidgetItem,
+    QProgressBar,
+    QHBoxLayout,
+    QHeaderView,
+    QInputDialog
 )
 import os
 from PyQt5.QtCore import QBuffer, QIODevice
-from PyQt5.QtGui import QFont, QPixmap, QIcon
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import fiona
-import geopandas as gpd
-import pyproj
-import shapely.affinity
-from shapely.geometry import Polygon, LineString, Point
-import utm
-from shapely.geometry import mapping
-from matplotlib.font_manager import FontProperties
-from PyQt5.QtCore import Qt
-
-class PlotWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("Plot Window")
-        self.setGeometry(200, 200, 600, 400)
-        self.plot_widget = QWidget(self)
-        self.setCentralWidget(self.plot_widget)
-        self.figure, self.ax = plt.subplots()  # Store figure and axes
-        self.canvas = FigureCanvas(self.figure)
-        self.setup_plot()
-
-    def setup_plot(self):
-        plot_layout = QVBoxLayout(self.plot_widget)
-        plot_layout.addWidget(self.canvas)
-
+from PyQt5.QtGui import QColor, QFont, QPixmap
+from PyQt5.QtCore import QThread, QTimer, pyqtSignal
+from mke_cache import PlanCache
+from mke_engine import AreaPipeline, PlanCancelled, SurveyParameters
+from mke_export import export_lines, export_points, export_sorties
+from mke_io import WGS84, kml_name, kml_placemark_names, preload, read_exclusions, read_kml_area, transform_coords
+from mke_optimize import best_angle, sweep_angles
+from mke_profile import diagnostics, profiled
+from mke_route import route_plan
+from mke_sortie import plan_sorties
+
+# Plans with more lines than this get a lines-only preview before the full plot
+PREVIEW_LINES = 2000
+# First choice when a KML file holds several placemarks
+ALL_PLACEMARKS = "All placemarks"
+
+
+def warm_up():
+    # Import the GIS and plotting libraries in the background once the main
+    # window is up, so the first KML import and plot do not wait for them.
+    # Set MKE_WARMUP=0 to skip this on machines short of memory
+    with diagnostics.timer("startup.warm_up"):
+        preload()
+        import mke_plot  # noqa: F401
 
 class SnapshotWindow(QMainWindow):
     def __init__(self, plot_data, parameters):
@@ -72,6 +77,204 @@ class SnapshotWindow(QMainWindow):
         params_label.setFont(times_font)
         layout.addWidget(params_label)
         
+class AngleSweepWindow(QMainWindow):
+    def __init__(self, results, best):
+        super().__init__()
+        self.setWindowTitle("Flight Direction Search")
+        self.setGeometry(300, 300, 600, 600)
+
+        # One row per angle, the cheapest one highlighted
+        table = QTableWidget(len(results), 6, self)
+        table.setHorizontalHeaderLabels(
+            ["Angle", "Total Length (km)", "Flight Length (km)", "Main Lines", "Cross Lines", "Turns"]
+        )
+        table.verticalHeader().setVisible(False)
+        table.setEditTriggers(QTableWidget.NoEditTriggers)
+        for row, result in enumerate(results):
+            values = [
+                f"{result.angle:g}",
+                f"{result.total_length_km:.2f}",
+                f"{result.flight_length_km:.2f}",
+                str(result.main_line_count),
+                str(result.cross_line_count),
+                str(result.turn_count),
+            ]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(value)
+                if result is best:
+                    item.setBackground(QColor("#CCE5CC"))
+                table.setItem(row, column, item)
+        table.resizeColumnsToContents()
+        table.scrollToItem(table.item(results.index(best), 0))
+        self.setCentralWidget(table)
+
+
+class DiagnosticsWindow(QMainWindow):
+    """Stage timings, counters and peak memory from the shared diagnostics."""
+
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Diagnostics")
+        self.setGeometry(300, 300, 560, 600)
+
+        central_widget = QWidget(self)
+        self.setCentralWidget(central_widget)
+        layout = QVBoxLayout(central_widget)
+
+        self.table = QTableWidget(0, 4, self)
+        self.table.setHorizontalHeaderLabels(["Name", "Calls / Count", "Total (ms)", "Last (ms)"])
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        layout.addWidget(self.table)
+
+        self.memory_label = QLabel(self)
+        layout.addWidget(self.memory_label)
+
+        buttons = QHBoxLayout()
+        self.trace_memory_checkbox = QCheckBox("Trace Memory", self)
+        self.trace_memory_checkbox.setToolTip("Measure the peak with tracemalloc; slows planning down")
+        self.trace_memory_checkbox.toggled.connect(self.trace_memory)
+        buttons.addWidget(self.trace_memory_checkbox)
+        refresh_button = QPushButton("Refresh", self)
+        refresh_button.clicked.connect(self.refresh)
+        buttons.addWidget(refresh_button)
+        reset_button = QPushButton("Reset", self)
+        reset_button.clicked.connect(self.reset)
+        buttons.addWidget(reset_button)
+        layout.addLayout(buttons)
+
+        self.refresh()
+
+    def trace_memory(self, enabled):
+        diagnostics.trace_memory(enabled)
+        self.refresh()
+
+    def reset(self):
+        diagnostics.reset()
+        self.refresh()
+
+    def refresh(self):
+        snapshot = diagnostics.snapshot()
+        rows = [
+            (name, str(timer["calls"]), f"{timer['seconds'] * 1000:.1f}", f"{timer['last_seconds'] * 1000:.1f}")
+            for name, timer in snapshot["timers"].items()
+        ]
+        rows += [(name, str(value), "", "") for name, value in snapshot["counters"].items()]
+        self.table.setRowCount(len(rows))
+        for row, values in enumerate(rows):
+            for column, value in enumerate(values):
+                self.table.setItem(row, column, QTableWidgetItem(value))
+
+        peak = snapshot["peak_memory_bytes"]
+        if peak is None:
+            self.memory_label.setText("Peak Memory: unknown")
+        else:
+            source = "traced since reset" if snapshot["memory_traced"] else "process"
+            self.memory_label.setText(f"Peak Memory ({source}): {peak / 2**20:.1f} MB")
+
+
+class PlanWorker(QThread):
+    """Plans the survey in the background and publishes it in steps.
+
+    The line totals come first, as soon as the plan is made, then a preview
+    of the lines while the route and sorties are worked out, then their
+    totals and the plan for the full plot. ``cancel`` stops the work at the
+    next stage and nothing more is published. With
+    ``profile_path`` set the work runs under cProfile and the statistics are
+    dumped there.
+    """
+
+    progress = pyqtSignal(int, str)
+    totals_ready = pyqtSignal(object)
+    preview_ready = pyqtSignal(object)
+    route_ready = pyqtSignal(object, object)
+    plan_ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, polygon, parameters, sortie_settings, pipeline, plan_cache, exclusions=None, parent=None):
+        super().__init__(parent)
+        self.polygon = polygon
+        self.parameters = parameters
+        self.exclusions = exclusions
+        self.sortie_settings = sortie_settings
+        self.pipeline = pipeline
+        self.plan_cache = plan_cache
+        self.cancelled = False
+        self.profile_path = None
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self, fraction, stage):
+        # Called between pipeline stages: report progress or stop
+        if self.cancelled:
+            raise PlanCancelled()
+        self.progress.emit(int(fraction * 80), stage.replace("_", " "))
+
+    def run(self):
+        if self.profile_path:
+            with profiled(self.profile_path):
+                self.plan_in_steps()
+        else:
+            self.plan_in_steps()
+
+    def plan_in_steps(self):
+        try:
+            plan = self.plan_cache.plan(
+                self.polygon,
+                self.parameters,
+                lambda polygon, parameters, exclusions: self.pipeline.plan(
+                    polygon, parameters, progress=self.check, exclusions=exclusions
+                ),
+                exclusions=self.exclusions,
+            )
+            self.check(1, "preview")
+            self.totals_ready.emit(plan)
+            self.preview_ready.emit(plan)
+            self.check(1.1, "route")
+            route = route_plan(plan)
+            sorties = None
+            if self.sortie_settings is not None:
+                try:
+                    sorties = plan_sorties(route, *self.sortie_settings)
+                except ValueError as e:
+                    sorties = str(e)
+            self.check(1.25, "drawing")
+            self.route_ready.emit(route, sorties)
+            self.plan_ready.emit(plan)
+        except PlanCancelled:
+            pass
+        except Exception as e:
+            # Anything escaping run() would abort the whole app
+            self.failed.emit(str(e) or type(e).__name__)
+
+
+class SweepWorker(QThread):
+    """Runs the flight direction search off the main thread.
+
+    The sweep has no stages to stop at, so it always runs to the end.
+    """
+
+    sweep_ready = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, polygon, parameters, step, exclusions=None, parent=None):
+        super().__init__(parent)
+        self.polygon = polygon
+        self.parameters = parameters
+        self.step = step
+        self.exclusions = exclusions
+
+    def run(self):
+        try:
+            results = sweep_angles(self.polygon, self.parameters, step=self.step, exclusions=self.exclusions)
+        except Exception as e:
+            self.failed.emit(str(e) or type(e).__name__)
+            return
+        self.sweep_ready.emit(results)
+
+
 class MainWindow(QMainWindow):
     def __init__(self):
         super().__init__()
@@ -80,6 +283,7 @@ class MainWindow(QMainWindow):
 
 
         self.add_about_menu()
+        self.add_diagnostics_menu()
 
         # Initialize attributes
         self.initAttributes()
@@ -113,6 +317,30 @@ class MainWindow(QMainWindow):
         about_action.triggered.connect(self.show_about_message)
         about_menu.addAction(about_action)
 
+    def add_diagnostics_menu(self):
+        diagnostics_menu = self.menuBar().addMenu('Diagnostics')
+
+        show_action = QAction('Show Diagnostics', self)
+        show_action.triggered.connect(self.show_diagnostics)
+        diagnostics_menu.addAction(show_action)
+
+        # The next plan runs under cProfile, for python -m pstats or snakeviz
+        profile_action = QAction('Profile Next Plan...', self)
+        profile_action.triggered.connect(self.profile_next_plan)
+        diagnostics_menu.addAction(profile_action)
+
+    def show_diagnostics(self):
+        if self.diagnostics_window is None:
+            self.diagnostics_window = DiagnosticsWindow()
+        self.diagnostics_window.refresh()
+        self.diagnostics_window.show()
+        self.diagnostics_window.raise_()
+
+    def profile_next_plan(self):
+        path, _ = QFileDialog.getSaveFileName(self, "Save Profile", "mke_plan.prof", "cProfile Files (*.prof)")
+        if path:
+            self.profile_path = path
+
     def show_about_message(self):
         # Display information about the program
         QMessageBox.about(self, "About",
@@ -120,8 +348,27 @@ class MainWindow(QMainWindow):
                           "for UAV-Borne Magnetometer Price Estimation")
         
     def initAttributes(self):
-        self.utm_zone_number = None
+        self.utm_epsg = None
         self.kml_file_name = ""
+        self.polygon_utm = None
+        # No-fly zones and other exclusion layers, kept in the projection of the polygon
+        self.exclusion_paths = []
+        self.exclusions = None
+        # Areas of several blocks are planned on every CPU
+        self.pipeline = AreaPipeline(workers=None)
+        # Finished plans are remembered, and kept across restarts when MKE_CACHE_DIR is set
+        self.plan_cache = PlanCache(directory=os.environ.get("MKE_CACHE_DIR"))
+        self.plan = None
+        # The polygon and exclusion layer self.plan was made for
+        self.plan_polygon = None
+        self.plan_exclusions = None
+        # Background planning, and whether another plan was asked for meanwhile
+        self.worker = None
+        self.replan_requested = False
+        # Background flight direction search, one at a time
+        self.sweep_worker = None
+        self.diagnostics_window = None
+        self.profile_path = None
 
     def setupWindow(self):
         self.setWindowTitle("MKE App")
@@ -158,6 +405,23 @@ class MainWindow(QMainWindow):
         input_layout.addRow("Ground Distance:", self.ground_distance_input)
         input_layout.addRow("Cross Line Spacing:", self.cross_line_spacing_input)  # Add cross line spacing to layout
 
+        # Fit the lines to the polygon instead of a large buffer around it
+        self.fit_lines_checkbox = QCheckBox("Fit Lines To Polygon")
+        input_layout.addRow(self.fit_lines_checkbox)
+
+        # Step used when searching for the cheapest rotation angle
+        self.angle_step_input = QLineEdit()
+        self.angle_step_input.setPlaceholderText("1")
+        input_layout.addRow("Angle Search Step:", self.angle_step_input)
+
+        # Sortie planning, only when an endurance is given
+        self.endurance_input = QLineEdit()
+        self.endurance_input.setPlaceholderText("No limit")
+        self.takeoff_input = QLineEdit()
+        self.takeoff_input.setPlaceholderText("Polygon centre")  # Longitude, latitude
+        input_layout.addRow("Endurance (km):", self.endurance_input)
+        input_layout.addRow("Take-off (lon, lat):", self.takeoff_input)
+
         # Set the layout and add to central layout
         input_group_box.setLayout(input_layout)
         self.central_layout.addWidget(input_group_box)
@@ -168,17 +432,37 @@ class MainWindow(QMainWindow):
         self.margin_input.editingFinished.connect(self.update_plot)
         self.ground_distance_input.editingFinished.connect(self.update_plot)
         self.cross_line_spacing_input.editingFinished.connect(self.update_plot)  # Connect cross line spacing input
+        self.fit_lines_checkbox.stateChanged.connect(self.update_plot)
+        self.endurance_input.editingFinished.connect(self.update_plot)
+        self.takeoff_input.editingFinished.connect(self.update_plot)
 
         # Buttons
         self.import_button = QPushButton("Import KML")
-        self.export_button = QPushButton("Export Lines to KML")
+        self.export_button = QPushButton("Export Lines")
+        self.export_points_button = QPushButton("Export Points")
         self.central_layout.addWidget(self.import_button)
+        exclusion_layout = QHBoxLayout()
+        load_exclusions_button = QPushButton("Load Exclusions", self)
+        clear_exclusions_button = QPushButton("Clear Exclusions", self)
+        exclusion_layout.addWidget(load_exclusions_button)
+        exclusion_layout.addWidget(clear_exclusions_button)
+        self.central_layout.addLayout(exclusion_layout)
+        load_exclusions_button.clicked.connect(self.load_exclusions)
+        clear_exclusions_button.clicked.connect(self.clear_exclusions)
         self.central_layout.addWidget(self.export_button)
+        self.central_layout.addWidget(self.export_points_button)
         self.import_button.clicked.connect(self.import_kml)
-        self.export_button.clicked.connect(self.export_lines_to_kml)
+        self.export_button.clicked.connect(self.export_lines)
+        self.export_points_button.clicked.connect(self.export_points)
+        export_sorties_button = QPushButton("Export Sorties", self)
+        self.central_layout.addWidget(export_sorties_button)
+        export_sorties_button.clicked.connect(self.export_sorties)
         snapshot_button = QPushButton("Take Snapshot", self)
         self.central_layout.addWidget(snapshot_button)
         snapshot_button.clicked.connect(self.take_snapshot)
+        self.optimize_button = QPushButton("Optimize Angle", self)
+        self.central_layout.addWidget(self.optimize_button)
+        self.optimize_button.clicked.connect(self.optimize_angle)
 
 
 
@@ -186,14 +470,41 @@ class MainWindow(QMainWindow):
         self.line_count_label = QLabel("Lines: 0")
         self.line_length_label = QLabel("Total Length: 0m")
         self.point_count_label = QLabel("Points: 0")
+        self.sortie_label = QLabel("Sorties: -")
         self.central_layout.addWidget(self.line_count_label)
         self.central_layout.addWidget(self.line_length_label)
         self.central_layout.addWidget(self.point_count_label)
+        self.central_layout.addWidget(self.sortie_label)
+
+        # Progress of the background planning, which can be cancelled at any time
+        progress_layout = QHBoxLayout()
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setFormat("Ready")
+        self.progress_bar.setValue(0)
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_plan)
+        progress_layout.addWidget(self.progress_bar)
+        progress_layout.addWidget(self.cancel_button)
+        self.central_layout.addLayout(progress_layout)
 
     def setupPlotWidget(self):
-            # Opens the plot in a new window
+            # The plot opens in its own window, created on the first plot
+            self.plot_window = None
+
+    def get_plot_window(self):
+        if self.plot_window is None:
+            # matplotlib is only imported here, unless the warm-up got to it first
+            from mke_plot import PlotWindow
+
             self.plot_window = PlotWindow()
-            # self.plot_window.show()
+        return self.plot_window
+
+    def window_shown(self):
+        # Called once the event loop is running: record the startup time, then warm up
+        diagnostics.record("startup.first_window", time.perf_counter() - STARTED)
+        if os.environ.get("MKE_WARMUP", "1") != "0":
+            threading.Thread(target=warm_up, daemon=True).start()
 
     def applyStylesheet(self):
         style = """
@@ -229,9 +540,13 @@ class MainWindow(QMainWindow):
         """
         self.setStyleSheet(style)
         self.snapshot_windows = []
+        self.sweep_windows = []
 
 
     def take_snapshot(self):
+        if self.plot_window is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon or change the parameters first.")
+            return
         try:
             buffer = QBuffer()
             buffer.open(QIODevice.WriteOnly)
@@ -262,297 +577,374 @@ class MainWindow(QMainWindow):
 
     def import_kml(self):
         kml_file_path, _ = QFileDialog.getOpenFileName(
-            None, "Select KML File", "", "KML Files (*.kml)"
+            None, "Select KML File", "", "KML Files (*.kml *.kmz)"
         )
 
         if kml_file_path:  # Check if a file is selected
-            # Extract the file name from the file path
-            kml_file_name_with_extension = os.path.basename(kml_file_path)
-            # Split the filename and extension
-            root, ext = os.path.splitext(kml_file_name_with_extension)
-            # Assign the filename without extension to self.kml_file_name
-            self.kml_file_name = root
+            # File name without directory and extension, used in the plot title
+            self.kml_file_name = kml_name(kml_file_path)
 
         try:
-
-            fiona.drvsupport.supported_drivers["KML"] = "rw"
-            gdf = gpd.read_file(kml_file_path, driver="KML")
-            
-
-            # Extract the polygon geometry
-            polygon = gdf.geometry.iloc[0]
-
-            # Get the centroid of the polygon
-            centroid = polygon.centroid
-
-            # Get the latitude and longitude of the centroid
-            lon, lat = centroid.x, centroid.y
-
-            # Get UTM zone number and zone letter from the centroid's coordinates
-            easting, northing, self.utm_zone_number, zone_letter = utm.from_latlon(lat, lon)
-
-            # Define UTM projection
-            utm_proj = pyproj.Proj(proj="utm", zone=self.utm_zone_number, ellps="WGS84")
-
-            # Extract the polygon geometry
-            polygon = gdf.geometry.iloc[0]
-            polygon_coords = list(polygon.exterior.coords)
-            polygon_coords = [
-                (coord[0], coord[1]) for coord in polygon_coords
-            ]  # Extract only (x, y) coordinates
-            self.polygon_utm = Polygon(polygon_coords)
-
-            # Convert polygon coordinates to UTM
-            polygon_coords_utm = [utm_proj(x, y) for x, y in polygon_coords]
-            self.polygon_utm = Polygon(polygon_coords_utm)
+            # A file with several placemarks can be surveyed whole or one placemark at a time
+            names = list(dict.fromkeys(kml_placemark_names(kml_file_path)))
+            placemark = None
+            if len(names) > 1:
+                choice, ok = QInputDialog.getItem(
+                    self, "Select Placemark", "Placemark to survey:", [ALL_PLACEMARKS] + names, 0, False
+                )
+                if not ok:
+                    return
+                if choice != ALL_PLACEMARKS:
+                    placemark = choice
+            self.polygon_utm, self.utm_epsg = read_kml_area(kml_file_path, placemark)
+            # The plan of the previous area must never be exported in the new UTM zone
+            self.plan = None
+            if self.exclusion_paths:
+                # The exclusions follow the new polygon into its UTM zone
+                self.exclusions = read_exclusions(self.exclusion_paths, self.utm_epsg)
 
             # Plot the polygon and lines
             self.plot_polygon()
         except Exception as e:
             QMessageBox.warning(self, "Error", "Please, choose a file.")
 
-    def ground_points(self, line, ground_distance):
-        # Calculate the number of points to be drawn on the line based on ground distance
-        num_points = int(line.length / ground_distance)
-
-        # Create an empty list to store the points
-        points = []
-
-        # Iterate along the line and add points to the list
-        for distance in np.linspace(0, line.length, num_points):
-            point = line.interpolate(distance)
-            points.append(point)
+    def load_exclusions(self):
+        if self.polygon_utm is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon first.")
+            return
+        paths, _ = QFileDialog.getOpenFileNames(None, "Select Exclusion Layers", "", "KML Files (*.kml *.kmz)")
+        if not paths:
+            return
+        try:
+            self.exclusions = read_exclusions(paths, self.utm_epsg)
+        except Exception as e:
+            # Unreadable files, broken KMZ archives and reprojection errors alike
+            QMessageBox.warning(self, "Error", str(e) or type(e).__name__)
+            return
+        self.exclusion_paths = paths
+        self.plan = None
+        self.update_plot()
+
+    def clear_exclusions(self):
+        self.exclusion_paths = []
+        self.exclusions = None
+        self.plan = None
+        self.update_plot()
+
+    def read_parameters(self):
+        # Collect the survey parameters from the input fields, falling back to the defaults
+        defaults = SurveyParameters()
+
+        def value(line_edit, default):
+            text = line_edit.text()
+            return float(text) if text else default
+
+        return SurveyParameters(
+            line_spacing=value(self.line_spacing_input, defaults.line_spacing),
+            angle=value(self.angle_input, defaults.angle),
+            margin=value(self.margin_input, defaults.margin),
+            ground_distance=value(self.ground_distance_input, defaults.ground_distance),
+            cross_line_spacing=value(self.cross_line_spacing_input, defaults.cross_line_spacing),
+            fit_to_polygon=self.fit_lines_checkbox.isChecked(),
+        )
 
-        return points
+    def read_sortie_settings(self):
+        # Endurance in km and take-off point in UTM, or None when no endurance is set
+        endurance_text = self.endurance_input.text()
+        if not endurance_text:
+            return None
+        takeoff_text = self.takeoff_input.text()
+        if takeoff_text:
+            try:
+                lon, lat = (float(value) for value in takeoff_text.split(","))
+            except ValueError:
+                raise ValueError("Take-off must be given as longitude, latitude.")
+            takeoff = transform_coords(np.array([[lon, lat]]), WGS84, self.utm_epsg)[0]
+        else:
+            takeoff = self.polygon_utm.centroid.coords[0]
+        return float(endurance_text), takeoff
+
+    def current_plan(self):
+        # The plan on screen when it matches the inputs, otherwise a fresh one that
+        # does not touch the background worker's pipeline
+        parameters = self.read_parameters()
+        if (
+            self.plan is not None
+            and self.plan.parameters == parameters
+            and self.plan_polygon is self.polygon_utm
+            and self.plan_exclusions is self.exclusions
+        ):
+            return self.plan
+        return self.plan_cache.plan(self.polygon_utm, parameters, exclusions=self.exclusions)
 
     def plot_polygon(self):
-        ax = self.plot_window.ax  # Correctly reference the axes
-        ax.clear()
-
-        # Set font properties for Times New Roman
-        font = FontProperties(family='Times New Roman', size=12)
-
-        # Plot original polygon
-        x, y = self.polygon_utm.exterior.xy
-        ax.plot(x, y, label="Original Polygon")
-
-        ax.ticklabel_format(style='plain', useOffset=False)
-        ax.set_aspect('equal')
-
-        # Plot buffered polygon
-        diagonal_length = np.sqrt(self.polygon_utm.area) * 2  # Diagonal length
-        buffered_polygon = self.polygon_utm.buffer(diagonal_length)
-
-        # Get line spacing from input field
-        line_spacing_text = self.line_spacing_input.text()
-        line_spacing = float(line_spacing_text) if line_spacing_text else 400
-        cross_line_text = self.cross_line_spacing_input.text()
-        cross_line_spacing = float(cross_line_text) if cross_line_text else 500
-
-        # Create lines inside the buffered polygon
-        lines, cross_lines = self.create_lines(buffered_polygon, line_spacing, cross_line_spacing)
-
-        # Get rotation angle from input field
-        angle_text = self.angle_input.text()
-        rotation_angle = float(angle_text) if angle_text else 0
-
-        # Trimmed lines inside the margin polygon
-        margin_input_text = self.margin_input.text()
-        margin = float(margin_input_text) if margin_input_text else 0
-        margin_polygon = self.polygon_utm.buffer(margin)
-
-        # Get ground distance from input field
-        ground_distance_text = self.ground_distance_input.text()
-        ground_distance = float(ground_distance_text) if ground_distance_text else 1000
-
-        main_line_count = 0  # Initialize main line count
-        cross_line_count = 0  # Initialize cross line count
-        total_main_line_length_km = 0  # Initialize total main line length in km
-        total_cross_line_length_km = 0  # Initialize total cross line length in km
-        total_points = 0  # Initialize total points count
-
-        # Plot main lines and count them
-        for line in lines:
-            rotated_line = shapely.affinity.rotate(line, rotation_angle, origin=buffered_polygon.centroid)
-            intersection = rotated_line.intersection(self.polygon_utm)
-
-            if not intersection.is_empty:
-                main_line_count += 1
-                margin_intersection = rotated_line.intersection(margin_polygon) if margin_input_text else intersection
-                if margin_intersection.geom_type == "MultiLineString":
-                    for trimmed_line in margin_intersection.geoms:
-                        ax.plot(*trimmed_line.xy, color="blue", label="Main Line")
-                        total_main_line_length_km += trimmed_line.length / 1000  # Add length in km
-                        for point in self.ground_points(trimmed_line, ground_distance):
-                            ax.plot(*point.xy, 'o', color='green')
-                            total_points += 1
-                else:
-                    ax.plot(*margin_intersection.xy, color="blue", label="Main Line")
-                    total_main_line_length_km += margin_intersection.length / 1000  # Add length in km
-                    for point in self.ground_points(margin_intersection, ground_distance):
-                        ax.plot(*point.xy, 'o', color='green')
-                        total_points += 1
-
-        # Plot cross lines and count them
-        for cross_line in cross_lines:
-            rotated_cross_line = shapely.affinity.rotate(cross_line, rotation_angle, origin=buffered_polygon.centroid)
-            cross_line_intersection = rotated_cross_line.intersection(self.polygon_utm)
-
-            if not cross_line_intersection.is_empty:
-                cross_line_count += 1
-                if cross_line_intersection.geom_type == "MultiLineString":
-                    for cross_rotated_line in cross_line_intersection.geoms:
-                        ax.plot(*cross_rotated_line.xy, color="purple", label="Cross Line")
-                        total_cross_line_length_km += cross_rotated_line.length / 1000  # Add length in km
-                else:
-                    ax.plot(*cross_line_intersection.xy, color="purple", label="Cross Line")
-                    total_cross_line_length_km += cross_line_intersection.length / 1000  # Add length in km
-
-        # Calculate combined total length
-        total_combined_length_km = total_main_line_length_km + total_cross_line_length_km
+        # Plan in the background; a plan already running is cancelled and
+        # restarted with the latest inputs as soon as it has stopped
+        parameters = self.read_parameters()
+        sortie_settings = self.read_sortie_settings()
+        if self.worker is not None:
+            self.worker.cancel()
+            self.replan_requested = True
+            return
+
+        self.worker = PlanWorker(
+            self.polygon_utm, parameters, sortie_settings, self.pipeline, self.plan_cache, self.exclusions, self
+        )
+        self.worker.profile_path, self.profile_path = self.profile_path, None
+        self.worker.progress.connect(self.show_progress)
+        self.worker.totals_ready.connect(self.show_totals)
+        self.worker.preview_ready.connect(self.show_preview)
+        self.worker.route_ready.connect(self.show_route)
+        self.worker.plan_ready.connect(self.show_plan)
+        self.worker.failed.connect(self.show_plan_error)
+        self.worker.finished.connect(self.plan_finished)
+        self.cancel_button.setEnabled(True)
+        self.show_progress(0, "planning")
+        self.worker.start()
+
+    def cancel_plan(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.replan_requested = False
+            self.progress_bar.setFormat("Cancelling")
+
+    def plan_finished(self):
+        worker, self.worker = self.worker, None
+        self.cancel_button.setEnabled(False)
+        if worker.cancelled and not self.replan_requested:
+            self.progress_bar.setValue(0)
+            self.progress_bar.setFormat("Cancelled")
+        if self.replan_requested:
+            self.replan_requested = False
+            self.update_plot()
+
+    def show_progress(self, value, stage):
+        self.progress_bar.setValue(value)
+        self.progress_bar.setFormat(f"%p% {stage}")
+
+    def is_stale(self):
+        # Results of a cancelled plan are never shown
+        return self.sender() is not self.worker or self.worker.cancelled
+
+    def show_plan_error(self, message):
+        if self.is_stale():
+            return
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("Failed")
+        QMessageBox.warning(self, "Error", message)
+
+    def plot_title(self):
+        return f"Geophysical Flight Path Design For {self.kml_file_name}"
+
+    def show_preview(self, plan):
+        if self.is_stale():
+            return
+        # Only big plans get a preview, small ones are drawn in full straight away
+        if len(plan.main_lines) > PREVIEW_LINES or len(plan.cross_lines) > PREVIEW_LINES:
+            self.get_plot_window().draw_preview(self.polygon_utm, plan, self.plot_title(), self.exclusions)
+
+    def show_plan(self, plan):
+        if self.is_stale():
+            return
+        self.get_plot_window().draw_plan(self.polygon_utm, plan, self.plot_title(), self.exclusions)
+        self.progress_bar.setValue(100)
+        self.progress_bar.setFormat("Done")
+        if self.diagnostics_window is not None and self.diagnostics_window.isVisible():
+            self.diagnostics_window.refresh()
+
+    def show_totals(self, plan):
+        if self.is_stale():
+            return
+        self.plan = plan
+        self.plan_polygon, self.plan_exclusions = self.worker.polygon, self.worker.exclusions
 
         # Update the line count label to show main and cross lines separately
-        self.line_count_label.setText(f"Main Lines: {main_line_count}, Cross Lines: {cross_line_count}")
+        line_count_text = f"Main Lines: {plan.main_line_count}, Cross Lines: {plan.cross_line_count}"
+        if plan.blocks:
+            line_count_text += f", Blocks: {len(plan.blocks)}"
+        self.line_count_label.setText(line_count_text)
 
         # Update the total length label to include main, cross lines separately, and combined total
-        # Update the total length label to include main, cross lines separately, and combined total
-        # Update the total length label to include main, cross lines separately, and combined total
-        self.line_length_label.setText(
-            f"Total Main Line Length (km): {total_main_line_length_km:.2f}\n"
-            f"Total Cross Line Length (km): {total_cross_line_length_km:.2f}\n"
-            f"Total Combined Length (km): {total_combined_length_km:.2f}")
+        self.show_lengths(plan)
 
-        self.point_count_label.setText(f"Total Points: {total_points}")
+        self.point_count_label.setText(f"Total Points: {plan.total_points}")
 
-        # Update the legend to show correct labels
-        legend_labels = ["Main Lines", "Cross Lines"]
-        ax.legend(legend_labels, prop=font)
-        ax.set_title(f"Geophysical Flight Path Design For {self.kml_file_name}", fontproperties=font)
+        self.sortie_label.setText("Sorties: -")
+        self.sortie_label.setToolTip("")
 
-        # Apply font to tick labels
-        for label in ax.get_xticklabels() + ax.get_yticklabels():
-            label.set_fontproperties(font)
-
-        # Refresh the canvas and display the plot
-        self.plot_window.canvas.draw()
-        self.plot_window.show()
-
-    def create_lines(self, polygon, line_spacing, cross_line_spacing):
-        diagonal_length = np.sqrt(
-            (polygon.bounds[2] - polygon.bounds[0]) ** 2
-            + (polygon.bounds[3] - polygon.bounds[1]) ** 2
+    def show_lengths(self, plan, route=None):
+        # The flight length is filled in once the route has been worked out
+        flight_text = (
+            f"Turns / Transit (km): {route.turn_km:.2f} / {route.ferry_km:.2f}\n"
+            f"Total Flight Length (km): {route.total_km:.2f}"
+            if route is not None
+            else "Turns / Transit (km): -\nTotal Flight Length (km): -"
         )
-        num_lines = int(diagonal_length / line_spacing)
-        lines = []
-        cross_lines = []
-
-        # Calculate the middle y-coordinate of the polygon's bounding box
-        mid_y = (polygon.bounds[1] + polygon.bounds[3]) / 2
-
-        # Calculate the maximum number of cross lines that can fit within the bounds
-        num_cross_lines = int(min(mid_y - polygon.bounds[1], polygon.bounds[3] - mid_y) / cross_line_spacing)
-
-        # Generate main lines
-        for i in range(num_lines):
-            x_coord = polygon.bounds[0] + i * line_spacing
-            line_start = Point(x_coord, polygon.bounds[1])
-            line_end = Point(x_coord, polygon.bounds[3])
-            line = LineString([line_start, line_end])
-            intersection = line.intersection(polygon)
-            if not intersection.is_empty:
-                if intersection.geom_type == "MultiLineString":
-                    lines.extend(intersection.geoms)
-                else:
-                    lines.append(intersection)
-
-        # Add a cross line at the midpoint
-        mid_cross_line_start = Point(polygon.bounds[0], mid_y)
-        mid_cross_line_end = Point(polygon.bounds[2], mid_y)
-        mid_cross_line = LineString([mid_cross_line_start, mid_cross_line_end])
-        intersection_mid_cross = mid_cross_line.intersection(polygon)
-        if not intersection_mid_cross.is_empty:
-            if intersection_mid_cross.geom_type == "MultiLineString":
-                cross_lines.extend(intersection_mid_cross.geoms)
-            else:
-                cross_lines.append(intersection_mid_cross)
-
-        # Generate cross lines above and below the midpoint
-        for j in range(1, num_cross_lines + 1):
-            # Create the upper cross line
-            upper_cross_line_start = Point(polygon.bounds[0], mid_y + j * cross_line_spacing)
-            upper_cross_line_end = Point(polygon.bounds[2], mid_y + j * cross_line_spacing)
-            upper_cross_line = LineString([upper_cross_line_start, upper_cross_line_end])
-            intersection_upper_cross = upper_cross_line.intersection(polygon)
-            if not intersection_upper_cross.is_empty:
-                if intersection_upper_cross.geom_type == "MultiLineString":
-                    cross_lines.extend(intersection_upper_cross.geoms)
-                else:
-                    cross_lines.append(intersection_upper_cross)
-
-            # Create the lower cross line
-            lower_cross_line_start = Point(polygon.bounds[0], mid_y - j * cross_line_spacing)
-            lower_cross_line_end = Point(polygon.bounds[2], mid_y - j * cross_line_spacing)
-            lower_cross_line = LineString([lower_cross_line_start, lower_cross_line_end])
-            intersection_lower_cross = lower_cross_line.intersection(polygon)
-            if not intersection_lower_cross.is_empty:
-                if intersection_lower_cross.geom_type == "MultiLineString":
-                    cross_lines.extend(intersection_lower_cross.geoms)
-                else:
-                    cross_lines.append(intersection_lower_cross)
-
-        return lines, cross_lines
+        self.line_length_label.setText(
+            f"Total Main Line Length (km): {plan.main_length_km:.2f}\n"
+            f"Total Cross Line Length (km): {plan.cross_length_km:.2f}\n"
+            f"Total Combined Length (km): {plan.total_length_km:.2f}\n"
+            + (f"Excluded Length (km): {plan.excluded_km:.2f}\n" if self.plan_exclusions is not None else "")
+            + flight_text)
+
+    def show_route(self, route, sorties):
+        if self.is_stale():
+            return
+        self.show_lengths(self.plan, route)
+        if isinstance(sorties, str):
+            # The plan is still shown when the endurance is too short
+            QMessageBox.warning(self, "Error", sorties)
+        elif sorties:
+            sortie_km = [sortie.total_km for sortie in sorties]
+            self.sortie_label.setText(
+                f"Sorties: {len(sorties)} ({min(sortie_km):.2f} - {max(sortie_km):.2f} km each)"
+            )
+            # Every sortie's km on hover, they can be too many for the label
+            self.sortie_label.setToolTip(
+                "\n".join(f"Sortie {number}: {km:.2f} km" for number, km in enumerate(sortie_km, start=1))
+            )
 
+    def optimize_angle(self):
+        if self.polygon_utm is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon first.")
+            return
+        if self.sweep_worker is not None:
+            return
+        try:
+            step_text = self.angle_step_input.text()
+            step = float(step_text) if step_text else 1
+            parameters = self.read_parameters()
+            parameters.validate()
+            if step <= 0:
+                raise ValueError("Angle step must be greater than zero.")
+        except ValueError as e:
+            QMessageBox.warning(self, "Error", str(e))
+            return
+
+        # The sweep runs in the background, the window stays responsive meanwhile
+        self.sweep_worker = SweepWorker(self.polygon_utm, parameters, step, self.exclusions, self)
+        self.sweep_worker.sweep_ready.connect(self.show_sweep)
+        self.sweep_worker.failed.connect(self.show_sweep_error)
+        self.sweep_worker.finished.connect(self.sweep_finished)
+        self.optimize_button.setEnabled(False)
+        self.optimize_button.setText("Optimizing...")
+        self.sweep_worker.start()
+
+    def sweep_finished(self):
+        self.sweep_worker = None
+        self.optimize_button.setEnabled(True)
+        self.optimize_button.setText("Optimize Angle")
+
+    def show_sweep_error(self, message):
+        QMessageBox.warning(self, "Error", message)
+
+    def show_sweep(self, results):
+        # A sweep of an area imported over since is of no use
+        if self.sender().polygon is not self.polygon_utm:
+            return
+        # Show every angle, then switch the plan to the cheapest one
+        best = best_angle(results)
+        sweep_window = AngleSweepWindow(results, best)
+        sweep_window.show()
+        self.sweep_windows.append(sweep_window)
+        self.angle_input.setText(f"{best.angle:g}")
+        self.update_plot()
+
+    def closeEvent(self, event):
+        # Let a running plan stop before the window goes away
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+        if self.sweep_worker is not None:
+            self.sweep_worker.wait()
+        self.pipeline.close()
+        super().closeEvent(event)
 
     def update_plot(self):
-        self.plot_polygon()
+        if self.polygon_utm is None:
+            return
+        try:
+            self.plot_polygon()
+        except ValueError as e:
+            QMessageBox.warning(self, "Error", str(e))
 
-    def export_lines_to_kml(self):
+    def export_lines(self):
+        if self.polygon_utm is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon first.")
+            return
         try:
-            # Get file path to save the KML file
+            # Get file path to save the lines, the format follows the chosen extension
             save_path, _ = QFileDialog.getSaveFileName(
-                None, "Save Lines as KML", "", "KML Files (*.kml)"
+                None,
+                "Save Lines",
+                self.kml_file_name,
+                "KML Files (*.kml);;GeoPackage (*.gpkg);;GeoJSON (*.geojson);;CSV Waypoints (*.csv)",
             )
 
             if save_path:
-                # Initialize a set to hold unique lines
-                unique_lines = set()
-
-                # Plot the polygon to get the current lines displayed on the plot
-                self.plot_polygon()
-
-                # Extract lines from the plot excluding the polygon
-                for line in self.plot_window.ax.lines:
-                    if line.get_label() in ["Main Line", "Cross Line"]:  # Exclude the polygon from export
-                        x, y = line.get_data()
-                        line_coords = tuple((x[i], y[i]) for i in range(len(x)))
-                        unique_lines.add(line_coords)
-
-                # Convert the set back to a list of LineString objects
-                all_lines = [LineString(line) for line in unique_lines]
-
-                # Create a GeoDataFrame from the lines
-                if all_lines:
-                    # Save the DataFrame to KML file
-                    fiona.drvsupport.supported_drivers['KML'] = 'rw'
-                    fiona.drvsupport.supported_drivers['LIBKML'] = 'rw'
-                    gdf_lines = gpd.GeoDataFrame(geometry=all_lines, crs=f'EPSG:326{self.utm_zone_number}')
-
-                    with fiona.open(save_path, 'w', driver='LIBKML', crs=f'EPSG:326{self.utm_zone_number}', schema={'geometry': 'LineString'}) as dst:
-                        for line in gdf_lines.geometry:
-                            dst.write({'geometry': {'type': 'LineString', 'coordinates': line.coords}})
-
-                    print("Lines exported to KML successfully.")
+                # Export straight from the current plan, without redrawing
+                plan = self.current_plan()
+                if len(plan.main_lines) + len(plan.cross_lines):
+                    export_lines(plan, save_path, self.utm_epsg, name=f"{self.kml_file_name} survey lines")
+                    print("Lines exported successfully.")
                 else:
                     print("No valid lines found for export.")
         except Exception as e:
             QMessageBox.warning(self, "Error", f"An error occurred: {str(e)}")
 
+    def export_points(self):
+        if self.polygon_utm is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon first.")
+            return
+        try:
+            # Get file path to save the ground points, the format follows the chosen extension
+            save_path, _ = QFileDialog.getSaveFileName(
+                None,
+                "Save Ground Points",
+                f"{self.kml_file_name} points",
+                "KML Files (*.kml);;GPX Waypoints (*.gpx);;CSV Files (*.csv);;NumPy Array, UTM (*.npy)",
+            )
+
+            if save_path:
+                plan = self.current_plan()
+                if plan.total_points:
+                    export_points(plan, save_path, self.utm_epsg, name=f"{self.kml_file_name} ground points")
+                    print("Points exported successfully.")
+                else:
+                    print("No ground points found for export.")
+        except Exception as e:
+            QMessageBox.warning(self, "Error", f"An error occurred: {str(e)}")
+
+
+    def export_sorties(self):
+        if self.polygon_utm is None:
+            QMessageBox.warning(self, "Error", "Please, add a polygon first.")
+            return
+        if not self.endurance_input.text():
+            QMessageBox.warning(self, "Error", "Please, set the endurance first.")
+            return
+        try:
+            # Every sortie becomes its own KML folder or GeoPackage layer
+            save_path, _ = QFileDialog.getSaveFileName(
+                None,
+                "Save Sorties",
+                f"{self.kml_file_name} sorties",
+                "KML Files (*.kml);;GeoPackage (*.gpkg)",
+            )
+
+            if save_path:
+                sorties = plan_sorties(route_plan(self.current_plan()), *self.read_sortie_settings())
+                export_sorties(sorties, save_path, self.utm_epsg, name=f"{self.kml_file_name} sorties")
+                print("Sorties exported successfully.")
+        except Exception as e:
+            QMessageBox.warning(self, "Error", f"An error occurred: {str(e)}")
 
 
 def main():
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
+    QTimer.singleShot(0, window.window_shown)
     sys.exit(app.exec_())
 
 
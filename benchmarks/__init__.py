@@ -0,0 +1,9 @@
+"""Benchmark suite for MKE.
+
+Run from the repository root:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --quick --compare benchmarks/results/<earlier run>.json
+
+See :mod:`benchmarks.run` for the options.
+"""
@@ -0,0 +1,382 @@
+"""Run the MKE benchmarks and store the results.
+
+For every synthetic area in :mod:`benchmarks.shapes` this times KML import
+of the area, and for every line spacing, angle and margin:
+
+* planning, stage by stage (grid, clipping, rotation, point counts, km totals)
+* building the ground points
+* exporting the lines as KML and the points as .npy
+* with ``--exclusions N``, planning again with the lines cut by N scattered
+  no-fly zones
+
+and records throughput, the peak traced memory of planning plus ground
+points, and how long the original planner (see :mod:`benchmarks.reference`)
+takes for the same totals. The engine's line counts, km and point counts are
+checked against the original planner, and with exclusions the km cut out
+and the totals left against shapely's difference of the same lines; any
+difference beyond the tolerances below fails the run. The original planner takes minutes on the 100k vertex
+area, so by default it only runs at the coarsest line spacing; ``--check all``
+runs it for every case.
+
+Results are written as JSON to ``benchmarks/results/`` and can be compared
+with an earlier run with ``--compare``:
+
+    python -m benchmarks.run --quick
+    python -m benchmarks.run --shapes concave high_vertex --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+import numpy as np
+import shapely
+
+from benchmarks.reference import reference_totals
+from benchmarks.shapes import EPSG, SHAPES, exclusions
+from mke_engine import ExclusionLayer, SurveyParameters, ground_points, plan_survey
+from mke_export import export_lines, export_points
+from mke_io import WGS84, read_kml_area, transform_geometry
+from mke_profile import diagnostics
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+LINE_SPACINGS = (100, 400)
+ANGLES = (0, 35, 90)
+# Without a margin, and with one, so the lines are trimmed to the buffered polygon
+MARGINS = (0, 150)
+# Areas only planned without a margin: GEOS runs out of memory buffering the
+# noisy 100k vertex outline, in the engine and the original planner alike
+NO_MARGIN = ("high_vertex",)
+# Ground stations every quarter line spacing, cross lines every five main lines
+GROUND_DISTANCE_RATIO = 0.25
+CROSS_LINE_RATIO = 5
+
+# Line counts must match exactly. Lengths are summed in a different order,
+# and the engine's point count forgives floating point noise at exact
+# multiples of the ground distance, so both get a little slack
+KM_TOLERANCE = 1e-6
+POINT_TOLERANCE = 1e-4
+TOTALS = ("main_line_count", "cross_line_count", "main_length_km", "cross_length_km", "total_points")
+EXCLUSION_TOTALS = TOTALS + ("excluded_km",)
+
+
+def _best(function, repeat):
+    # Fastest of ``repeat`` calls and the result of the last one
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def write_area_kml(polygon, path, name="Benchmark area"):
+    # One Placemark in lon/lat, holes included
+    polygon = transform_geometry(polygon, EPSG, WGS84)
+
+    def ring(coords):
+        return " ".join(f"{lon:.9f},{lat:.9f}" for lon, lat in coords)
+
+    holes = "".join(
+        f"<innerBoundaryIs><LinearRing><coordinates>{ring(interior.coords)}</coordinates></LinearRing></innerBoundaryIs>"
+        for interior in polygon.interiors
+    )
+    with open(path, "w", encoding="utf-8") as kml:
+        kml.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+            f"<Placemark><name>{escape(name)}</name><Polygon><outerBoundaryIs><LinearRing><coordinates>"
+            f"{ring(polygon.exterior.coords)}</coordinates></LinearRing></outerBoundaryIs>{holes}</Polygon></Placemark>\n"
+            "</Document>\n</kml>\n"
+        )
+
+
+def check_totals(plan, expected, names=TOTALS):
+    # Names of the totals that differ from the original planner beyond tolerance
+    failed = []
+    for name in names:
+        value, reference = getattr(plan, name), expected[name]
+        if name.endswith("_count"):
+            ok = value == reference
+        elif name == "total_points":
+            ok = abs(value - reference) <= POINT_TOLERANCE * max(reference, 1)
+        else:
+            ok = abs(value - reference) <= KM_TOLERANCE * max(abs(reference), 1)
+        if not ok:
+            failed.append(name)
+    return failed
+
+
+def benchmark_import(name, polygon, directory, repeat):
+    path = os.path.join(directory, f"{name}.kml")
+    write_area_kml(polygon, path, name)
+    seconds, (area, epsg) = _best(lambda: read_kml_area(path), repeat)
+    return {
+        "vertices": int(shapely.get_num_coordinates(polygon)),
+        "holes": len(polygon.interiors),
+        "kml_bytes": os.path.getsize(path),
+        "kml_read_seconds": round(seconds, 6),
+        "kml_vertices_per_second": round(shapely.get_num_coordinates(polygon) / seconds),
+    }
+
+
+def benchmark_plan(polygon, parameters, directory, repeat, max_points, check, trace_memory, exclusion_layer=None):
+    """Time one plan and everything built from it; returns the result record."""
+    # Stage timings come from the fastest of the runs
+    stages, best = {}, None
+    for _ in range(repeat):
+        diagnostics.reset()
+        start = time.perf_counter()
+        plan = plan_survey(polygon, parameters)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            stages = {
+                name[len("pipeline."):]: timer["seconds"]
+                for name, timer in diagnostics.snapshot()["timers"].items()
+                if name.startswith("pipeline.") and name != "pipeline.plan"
+            }
+
+    segments = len(plan.main_lines) + len(plan.cross_lines)
+    record = {
+        "line_spacing": parameters.line_spacing,
+        "angle": parameters.angle,
+        "margin": parameters.margin,
+        "ground_distance": parameters.ground_distance,
+        "cross_line_spacing": parameters.cross_line_spacing,
+        "plan_seconds": round(best, 6),
+        "stage_seconds": stages,
+        "segments": segments,
+        "segments_per_second": round(segments / best),
+        "line_km_per_second": round(plan.total_length_km / best, 3),
+    }
+    record.update({name: getattr(plan, name) for name in TOTALS})
+    record["total_length_km"] = plan.total_length_km
+
+    # Building, exporting and tracing millions of points is only done up to max_points
+    if plan.total_points <= max_points:
+        seconds, _ = _best(lambda: ground_points(plan.main_lines, parameters.ground_distance), repeat)
+        record["ground_points_seconds"] = round(seconds, 6)
+        record["points_per_second"] = round(plan.total_points / seconds) if seconds else None
+        lines_path = os.path.join(directory, "lines.kml")
+        points_path = os.path.join(directory, "points.npy")
+        record["export_lines_kml_seconds"] = round(_best(lambda: export_lines(plan, lines_path, EPSG), 1)[0], 6)
+        record["export_points_npy_seconds"] = round(_best(lambda: export_points(plan, points_path, EPSG), 1)[0], 6)
+        if trace_memory:
+            diagnostics.trace_memory(True)
+            diagnostics.reset()
+            ground_points(plan_survey(polygon, parameters).main_lines, parameters.ground_distance)
+            record["peak_memory_bytes"] = diagnostics.peak_memory()
+            diagnostics.trace_memory(False)
+    else:
+        record["skipped"] = f"more than {max_points} ground points"
+
+    if exclusion_layer is not None:
+        # The same plan with the lines cut by the exclusions, stage times from the fastest run
+        best_cut = None
+        for _ in range(repeat):
+            diagnostics.reset()
+            start = time.perf_counter()
+            cut_plan = plan_survey(polygon, parameters, exclusions=exclusion_layer)
+            elapsed = time.perf_counter() - start
+            if best_cut is None or elapsed < best_cut:
+                best_cut = elapsed
+                timers = diagnostics.snapshot()["timers"]
+                exclusion_seconds = sum(
+                    timers.get(f"pipeline.{name}", {}).get("seconds", 0)
+                    for name in ("exclusion_area", "main_exclude", "cross_exclude")
+                )
+        record["exclusion_plan_seconds"] = round(best_cut, 6)
+        record["exclusion_stage_seconds"] = round(exclusion_seconds, 6)
+        record["exclusion_segments"] = len(cut_plan.main_lines) + len(cut_plan.cross_lines)
+        record["excluded_km"] = cut_plan.excluded_km
+
+    if check:
+        start = time.perf_counter()
+        expected = reference_totals(polygon, parameters)
+        reference_seconds = time.perf_counter() - start
+        record["reference"] = expected
+        record["reference_seconds"] = round(reference_seconds, 6)
+        record["speedup"] = round(reference_seconds / best, 1)
+        record["check_failed"] = check_totals(plan, expected)
+        if exclusion_layer is not None:
+            expected_cut = reference_totals(polygon, parameters, exclusion_layer.polygons)
+            record["exclusion_reference"] = expected_cut
+            record["check_failed"] += [
+                f"exclusions.{name}" for name in check_totals(cut_plan, expected_cut, EXCLUSION_TOTALS)
+            ]
+    return record
+
+
+def run(
+    shapes,
+    line_spacings,
+    angles,
+    margins=MARGINS,
+    repeat=3,
+    max_points=5000000,
+    check="coarsest",
+    trace_memory=True,
+    exclusion_count=0,
+):
+    """Run the suite over ``shapes`` and return the results as one JSON-ready dict.
+
+    ``check`` is "all", "coarsest" or "none": which line spacings are
+    checked against the original planner. With ``exclusion_count`` every
+    plan is also timed with that many no-fly zones cut out of it.
+    """
+    results = {
+        "created": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "numpy": np.__version__,
+            "shapely": shapely.__version__,
+            "geos": shapely.geos_version_string,
+        },
+        "repeat": repeat,
+        "check": check,
+        "exclusions": exclusion_count,
+        "areas": {},
+    }
+    exclusion_layer = ExclusionLayer(exclusions(exclusion_count)) if exclusion_count else None
+    with tempfile.TemporaryDirectory() as directory:
+        for name in shapes:
+            polygon = SHAPES[name]()
+            area = benchmark_import(name, polygon, directory, repeat)
+            print(f"{name}: {area['vertices']} vertices, KML read {area['kml_read_seconds'] * 1000:.1f} ms", flush=True)
+            area["plans"] = []
+            for line_spacing in line_spacings:
+                area_margins = [margin for margin in margins if not margin or name not in NO_MARGIN]
+                for angle, margin in itertools.product(angles, area_margins):
+                    parameters = SurveyParameters(
+                        line_spacing=line_spacing,
+                        angle=angle,
+                        margin=margin,
+                        ground_distance=line_spacing * GROUND_DISTANCE_RATIO,
+                        cross_line_spacing=line_spacing * CROSS_LINE_RATIO,
+                    )
+                    checked = check == "all" or (check == "coarsest" and line_spacing == max(line_spacings))
+                    record = benchmark_plan(
+                        polygon, parameters, directory, repeat, max_points, checked, trace_memory, exclusion_layer
+                    )
+                    area["plans"].append(record)
+                    print("  " + _summary(record), flush=True)
+            results["areas"][name] = area
+    return results
+
+
+def _summary(record):
+    # One line per plan for the console
+    text = (
+        f"{_case(record)}: "
+        f"{record['plan_seconds'] * 1000:.1f} ms, {record['segments']} segments, "
+        f"{record['total_length_km']:.1f} km, {record['total_points']} points"
+    )
+    if "ground_points_seconds" in record:
+        text += f", points {record['ground_points_seconds'] * 1000:.1f} ms"
+    if record.get("peak_memory_bytes"):
+        text += f", peak {record['peak_memory_bytes'] / 2**20:.1f} MB"
+    if "exclusion_plan_seconds" in record:
+        text += (
+            f", with exclusions {record['exclusion_plan_seconds'] * 1000:.1f} ms"
+            f" ({record['excluded_km']:.1f} km cut)"
+        )
+    if "speedup" in record:
+        text += f", {record['speedup']:g}x original"
+        if record["check_failed"]:
+            text += f", MISMATCH {', '.join(record['check_failed'])}"
+    return text
+
+
+def _case(record):
+    # The parameters that tell the plans of one area apart; older results have no margin
+    return f"spacing {record['line_spacing']:g} angle {record['angle']:g} margin {record.get('margin', 0):g}"
+
+
+def compare(results, earlier):
+    # Plan time of every case against an earlier run of the same case
+    print(f"\nCompared with {earlier['created']}:")
+    for name, area in results["areas"].items():
+        old = {_case(plan): plan for plan in earlier["areas"].get(name, {}).get("plans", [])}
+        for plan in area["plans"]:
+            before = old.get(_case(plan))
+            if before is None:
+                continue
+            ratio = before["plan_seconds"] / plan["plan_seconds"] if plan["plan_seconds"] else float("inf")
+            print(
+                f"  {name} {_case(plan)}: "
+                f"{before['plan_seconds'] * 1000:.1f} -> {plan['plan_seconds'] * 1000:.1f} ms ({ratio:.2f}x)"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MKE planning, KML import and export on synthetic areas.")
+    parser.add_argument("--shapes", nargs="+", choices=sorted(SHAPES), default=list(SHAPES), help="areas to run")
+    parser.add_argument("--line-spacing", nargs="+", type=float, default=list(LINE_SPACINGS), help="metres")
+    parser.add_argument("--angle", nargs="+", type=float, default=list(ANGLES), help="degrees")
+    parser.add_argument("--margin", nargs="+", type=float, default=list(MARGINS), help="metres")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the fastest counts (default: 3)")
+    parser.add_argument("--quick", action="store_true", help="one spacing and angle, one run per case")
+    parser.add_argument(
+        "--max-points", type=int, default=5000000, help="skip building points for larger plans (default: 5000000)"
+    )
+    parser.add_argument(
+        "--check",
+        choices=("all", "coarsest", "none"),
+        default="coarsest",
+        help="line spacings to check against the original planner (default: coarsest)",
+    )
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced memory run")
+    parser.add_argument(
+        "--exclusions", type=int, default=0, metavar="N", help="also plan with N scattered no-fly zones cut out"
+    )
+    parser.add_argument("-o", "--output", help="results file (default: benchmarks/results/<time>.json)")
+    parser.add_argument("--compare", metavar="JSON", help="earlier results to compare plan times with")
+    args = parser.parse_args(argv)
+
+    line_spacings, angles, repeat = args.line_spacing, args.angle, args.repeat
+    if args.quick:
+        line_spacings, angles, repeat = line_spacings[-1:], angles[1:2] or angles, 1
+    results = run(
+        args.shapes,
+        line_spacings,
+        angles,
+        args.margin,
+        repeat,
+        args.max_points,
+        args.check,
+        not args.no_memory,
+        args.exclusions,
+    )
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    with open(output, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        with open(args.compare) as earlier_file:
+            compare(results, json.load(earlier_file))
+
+    failed = [
+        (name, plan) for name, area in results["areas"].items() for plan in area["plans"] if plan.get("check_failed")
+    ]
+    for name, plan in failed:
+        print(f"MISMATCH {name} {_case(plan)}: {plan['check_failed']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
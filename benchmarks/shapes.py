@@ -0,0 +1,109 @@
+"""Synthetic survey areas for the benchmarks.
+
+Every area is a single polygon in UTM zone 33N metres, generated from a fixed
+seed so runs on different machines plan exactly the same geometry. Each one
+stresses a different part of the engine:
+
+* convex      - the easy case, few segments per line
+* concave     - a comb whose teeth cut every main line into many segments
+* multi_hole  - a block with hundreds of holes, many crossings per line
+* high_vertex - a 100k vertex outline, edge handling dominates
+* huge_extent - a 400 km block, many long lines and millions of points
+
+``exclusions`` scatters no-fly zones over all of them, for timing the
+exclusion cuts.
+"""
+import numpy as np
+from shapely.geometry import Polygon
+
+# UTM zone 33N, with the areas placed around its central meridian
+EPSG = 32633
+ORIGIN = (500000.0, 4500000.0)
+
+
+def _radial(radii, angles):
+    # Star-shaped outline around ORIGIN; simple as long as every radius is positive
+    return np.column_stack([ORIGIN[0] + radii * np.cos(angles), ORIGIN[1] + radii * np.sin(angles)])
+
+
+def convex(vertices=256, width=20000, height=12000):
+    # An ellipse
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    return Polygon(np.column_stack([ORIGIN[0] + width / 2 * np.cos(angles), ORIGIN[1] + height / 2 * np.sin(angles)]))
+
+
+def concave(teeth=60, width=30000, depth=20000, base=2000):
+    # A comb: a strip along the bottom with ``teeth`` narrow teeth standing on it
+    pitch = width / teeth
+    x0, y0 = ORIGIN[0] - width / 2, ORIGIN[1] - depth / 2
+    outline = [(x0, y0)]
+    for tooth in range(teeth):
+        left = x0 + tooth * pitch
+        outline += [(left, y0 + depth), (left + pitch / 2, y0 + depth), (left + pitch / 2, y0 + base)]
+    outline += [(x0 + width, y0 + base), (x0 + width, y0)]
+    return Polygon(outline)
+
+
+def multi_hole(holes=400, width=25000, height=20000, seed=1):
+    # A rectangle with a jittered grid of round holes that never touch
+    rng = np.random.default_rng(seed)
+    columns = int(np.ceil(np.sqrt(holes * width / height)))
+    rows = int(np.ceil(holes / columns))
+    cell = min(width / columns, height / rows)
+    x0, y0 = ORIGIN[0] - width / 2, ORIGIN[1] - height / 2
+    rings = []
+    angles = np.linspace(0, 2 * np.pi, 24, endpoint=False)
+    for index in range(holes):
+        row, column = divmod(index, columns)
+        radius = cell * rng.uniform(0.15, 0.3)
+        jitter = rng.uniform(-0.15, 0.15, 2) * cell
+        cx = x0 + (column + 0.5) * cell + jitter[0]
+        cy = y0 + (row + 0.5) * cell + jitter[1]
+        # Clockwise, as holes are usually stored
+        rings.append(np.column_stack([cx + radius * np.cos(-angles), cy + radius * np.sin(-angles)]))
+    shell = [(x0, y0), (x0 + width, y0), (x0 + width, y0 + height), (x0, y0 + height)]
+    return Polygon(shell, rings)
+
+
+def high_vertex(vertices=100000, radius=15000, seed=2):
+    # A wavy, noisy circle with ``vertices`` vertices
+    rng = np.random.default_rng(seed)
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radii = radius * (1 + 0.08 * np.sin(37 * angles) + 0.02 * np.sin(411 * angles) + 0.005 * rng.standard_normal(vertices))
+    return Polygon(_radial(radii, angles))
+
+
+def huge_extent(width=400000, height=300000):
+    # A skewed hexagon about 400 x 300 km
+    x0, y0 = ORIGIN[0] - width / 2, ORIGIN[1] - height / 2
+    return Polygon(
+        [
+            (x0, y0 + 0.2 * height),
+            (x0 + 0.45 * width, y0),
+            (x0 + width, y0 + 0.1 * height),
+            (x0 + 0.9 * width, y0 + 0.85 * height),
+            (x0 + 0.4 * width, y0 + height),
+            (x0 + 0.05 * width, y0 + 0.7 * height),
+        ]
+    )
+
+
+SHAPES = {
+    "convex": convex,
+    "concave": concave,
+    "multi_hole": multi_hole,
+    "high_vertex": high_vertex,
+    "huge_extent": huge_extent,
+}
+
+
+def exclusions(count=10000, extent=450000, seed=3):
+    # ``count`` overlapping round zones of 100 m to 2 km radius, spread over
+    # an ``extent`` square around ORIGIN so every area gets its share
+    rng = np.random.default_rng(seed)
+    centres = np.array(ORIGIN) + rng.uniform(-extent / 2, extent / 2, (count, 2))
+    angles = np.linspace(0, 2 * np.pi, 12, endpoint=False)
+    return [
+        Polygon(np.column_stack([x + radius * np.cos(angles), y + radius * np.sin(angles)]))
+        for (x, y), radius in zip(centres, rng.uniform(100, 2000, count))
+    ]
@@ -0,0 +1,91 @@
+"""Measure how long MKE takes to show its main window.
+
+Every run starts a fresh Python process that imports MKE_GUI_V3, builds the
+main window, shows it and waits for the event loop to start, the way ``main``
+does. It reports the time to the first window as MKE itself records it
+(from the start of MKE_GUI_V3), the wall time of the whole process
+(interpreter start-up included), which of the heavy libraries were loaded by
+then, and how long the background warm-up took afterwards.
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 10 --offscreen -o startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("matplotlib", "geopandas", "fiona", "pyproj", "pandas")
+
+_CHILD = """
+import json, os, sys, threading, time
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QApplication
+app = QApplication(sys.argv)
+import MKE_GUI_V3
+from mke_profile import diagnostics
+window = MKE_GUI_V3.MainWindow()
+window.show()
+
+def shown():
+    # The parent's wall clock start, so interpreter start-up is included
+    process_seconds = time.time() - float(os.environ["MKE_BENCHMARK_STARTED"])
+    window.window_shown()
+    loaded = [name for name in %r if name in sys.modules]
+    for thread in threading.enumerate():
+        if thread.daemon:
+            thread.join()
+    timers = diagnostics.snapshot()["timers"]
+    print(json.dumps({
+        "first_window_seconds": timers["startup.first_window"]["seconds"],
+        "process_seconds": round(process_seconds, 6),
+        "warm_up_seconds": timers.get("startup.warm_up", {}).get("seconds"),
+        "loaded_at_first_window": loaded,
+    }))
+    app.quit()
+
+QTimer.singleShot(0, shown)
+app.exec_()
+""" % (HEAVY_MODULES,)
+
+
+def measure(warm_up=True, offscreen=False):
+    # Time to the first window in one fresh process
+    env = dict(os.environ, MKE_WARMUP="1" if warm_up else "0", MKE_BENCHMARK_STARTED=repr(time.time()))
+    if offscreen:
+        env["QT_QPA_PLATFORM"] = "offscreen"
+    output = subprocess.run(
+        [sys.executable, "-c", _CHILD], cwd=REPOSITORY, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the time MKE takes to show its main window.")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to start (default: 5)")
+    parser.add_argument("--no-warm-up", action="store_true", help="start with MKE_WARMUP=0")
+    parser.add_argument("--offscreen", action="store_true", help="use Qt's offscreen platform, for machines without a display")
+    parser.add_argument("-o", "--output", help="also write the runs as JSON")
+    args = parser.parse_args(argv)
+
+    runs = [measure(not args.no_warm_up, args.offscreen) for _ in range(args.runs)]
+    first_window = [run["first_window_seconds"] for run in runs]
+    process = [run["process_seconds"] for run in runs]
+    print(f"Time to first window: median {statistics.median(first_window) * 1000:.0f} ms, best {min(first_window) * 1000:.0f} ms")
+    print(f"Process start to first window: median {statistics.median(process) * 1000:.0f} ms")
+    warm_up = [run["warm_up_seconds"] for run in runs if run["warm_up_seconds"] is not None]
+    if warm_up:
+        print(f"Background warm-up: median {statistics.median(warm_up) * 1000:.0f} ms")
+    print(f"Heavy libraries loaded before the window: {', '.join(runs[-1]['loaded_at_first_window']) or 'none'}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"runs": runs}, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Command-line batch estimation for MKE.
+
+Estimates every KML or KMZ file found in the given directories, globs or paths over
+a grid of parameters, in parallel worker processes, and streams one row per
+file and parameter set to CSV or JSON Lines as soon as each file finishes::
+
+    python mke_batch.py tenders/ "clients/*.kml" --line-spacing 200 400 \\
+        --angle 0 45 90 --ground-distance 500 1000 -o estimates.csv
+
+No display is needed. ``--exclusions no_fly.kml`` cuts the lines out of the
+polygons of one or more exclusion layers. ``--block-workers N`` also plans the
+blocks of each file in N processes, for files of many blocks. ``--diagnostics report.json`` also writes per-file
+stage timings and counters, and ``--cprofile run.prof`` a cProfile dump.
+"""
+import argparse
+import contextlib
+import csv
+import functools
+import glob
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from mke_engine import AreaPipeline, SurveyParameters
+from mke_io import WGS84, as_area, read_exclusions, read_kml_blocks, transform_coords
+from mke_profile import diagnostics, merge_snapshots, profiled
+from mke_route import route_plan
+from mke_sortie import plan_sorties
+
+FIELDS = [
+    "file",
+    "block",
+    "block_count",
+    "utm_epsg",
+    "line_spacing",
+    "angle",
+    "margin",
+    "ground_distance",
+    "cross_line_spacing",
+    "fit_to_polygon",
+    "main_line_count",
+    "cross_line_count",
+    "main_length_km",
+    "cross_length_km",
+    "total_length_km",
+    "excluded_km",
+    "turn_km",
+    "ferry_km",
+    "flight_length_km",
+    "total_points",
+    "sortie_count",
+    "max_sortie_km",
+    "error",
+]
+
+
+def find_kml_files(inputs):
+    # Directories contribute their *.kml and *.kmz files, anything else is a path or a glob
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, "*.kml")) + glob.glob(os.path.join(item, "*.kmz"))))
+        elif glob.has_magic(item):
+            files.extend(sorted(glob.glob(item)))
+        else:
+            files.append(item)
+    return list(dict.fromkeys(files))
+
+
+def parameter_grid(
+    line_spacings=(400,),
+    angles=(0,),
+    margins=(0,),
+    ground_distances=(1000,),
+    cross_line_spacings=(500,),
+    fit_to_polygon=False,
+):
+    # Every combination of the given values, validated up front
+    grid = [
+        SurveyParameters(
+            line_spacing=line_spacing,
+            angle=angle,
+            margin=margin,
+            ground_distance=ground_distance,
+            cross_line_spacing=cross_line_spacing,
+            fit_to_polygon=fit_to_polygon,
+        )
+        for line_spacing, angle, margin, ground_distance, cross_line_spacing in itertools.product(
+            line_spacings, angles, margins, ground_distances, cross_line_spacings
+        )
+    ]
+    for parameters in grid:
+        parameters.validate()
+    return grid
+
+
+def _row(path, block, block_count, utm_epsg, parameters, plan, endurance=None, takeoff=None):
+    route = route_plan(plan)
+    sorties = plan_sorties(route, endurance, takeoff) if endurance else None
+    return {
+        "file": path,
+        "block": block,
+        "block_count": block_count,
+        "utm_epsg": utm_epsg,
+        "line_spacing": parameters.line_spacing,
+        "angle": parameters.angle,
+        "margin": parameters.margin,
+        "ground_distance": parameters.ground_distance,
+        "cross_line_spacing": parameters.cross_line_spacing,
+        "fit_to_polygon": parameters.fit_to_polygon,
+        "main_line_count": plan.main_line_count,
+        "cross_line_count": plan.cross_line_count,
+        "main_length_km": round(plan.main_length_km, 6),
+        "cross_length_km": round(plan.cross_length_km, 6),
+        "total_length_km": round(plan.total_length_km, 6),
+        "excluded_km": round(plan.excluded_km, 6),
+        "turn_km": round(route.turn_km, 6),
+        "ferry_km": round(route.ferry_km, 6),
+        "flight_length_km": round(route.total_km, 6),
+        "total_points": plan.total_points,
+        "sortie_count": len(sorties) if sorties is not None else "",
+        "max_sortie_km": round(max(sortie.total_km for sortie in sorties), 6) if sorties else "",
+        "error": "",
+    }
+
+
+@functools.lru_cache(maxsize=8)
+def _exclusion_layer(paths, epsg):
+    # Every file in the same UTM zone shares one indexed layer per process
+    return read_exclusions(paths, epsg)
+
+
+def estimate_file(
+    path, grid, per_block=False, endurance=None, takeoff=None, placemark=None, exclusions=(), block_workers=1
+):
+    """Plan one KML file for every parameter set and return the result rows.
+
+    Each parameter set gives one row for the whole file (block ``all``),
+    followed by one row per block with ``per_block``. With an ``endurance``
+    in km the route is also split into sorties flown from ``takeoff``
+    (lon, lat), or from the centre of the survey area. With ``placemark``
+    only the placemarks of that name are planned. The lines are cut out of
+    the polygons of the ``exclusions`` KML files. The blocks of the file are
+    planned in ``block_workers`` processes. A file that cannot be read or
+    planned gives a single row carrying the error.
+    """
+    try:
+        names, polygons, utm_epsg = read_kml_blocks(path, placemark)
+        area = as_area(polygons)
+        layer = _exclusion_layer(tuple(exclusions), utm_epsg) if exclusions else None
+        if takeoff is not None:
+            takeoff_utm = transform_coords(np.array([takeoff], dtype=float), WGS84, utm_epsg)[0]
+        else:
+            takeoff_utm = area.centroid.coords[0]
+
+        # One pipeline per file, so stages shared between parameter sets run once
+        rows = []
+        with AreaPipeline(block_workers) as pipeline:
+            for parameters in grid:
+                plan = pipeline.plan(area, parameters, exclusions=layer)
+                rows.append(_row(path, "all", len(polygons), utm_epsg, parameters, plan, endurance, takeoff_utm))
+                if per_block:
+                    for name, block_plan in zip(names, plan.blocks or [plan]):
+                        rows.append(_row(path, name, 1, utm_epsg, parameters, block_plan, endurance, takeoff_utm))
+    except Exception as e:
+        return [{"file": path, "error": str(e) or type(e).__name__}]
+    return rows
+
+
+def diagnose_file(
+    path,
+    grid,
+    per_block=False,
+    endurance=None,
+    takeoff=None,
+    placemark=None,
+    exclusions=(),
+    trace_memory=False,
+    block_workers=1,
+):
+    # estimate_file plus the timings and counters it produced, in whichever process runs it
+    diagnostics.trace_memory(trace_memory)
+    diagnostics.reset()
+    start = time.perf_counter()
+    rows = estimate_file(path, grid, per_block, endurance, takeoff, placemark, exclusions, block_workers)
+    report = {"file": path, "wall_seconds": round(time.perf_counter() - start, 6)}
+    report.update(diagnostics.snapshot())
+    return rows, report
+
+
+def _no_diagnostics(path, grid, per_block, endurance, takeoff, placemark, exclusions, trace_memory, block_workers):
+    return estimate_file(path, grid, per_block, endurance, takeoff, placemark, exclusions, block_workers), None
+
+
+def estimate_files(
+    files,
+    grid,
+    workers=None,
+    per_block=False,
+    endurance=None,
+    takeoff=None,
+    diagnose=False,
+    trace_memory=False,
+    placemark=None,
+    exclusions=(),
+    block_workers=1,
+):
+    """Yield ``(rows, report)`` for every file as the files finish.
+
+    ``rows`` is the file's list of result rows. ``report`` holds its stage
+    timings and counters with ``diagnose``, and is None otherwise.
+    ``workers`` is the number of processes to use; ``None`` uses every CPU and
+    ``1`` runs in this process. Each of them plans the blocks of its file in
+    ``block_workers`` processes of its own.
+    """
+    run = diagnose_file if diagnose else _no_diagnostics
+    arguments = (grid, per_block, endurance, takeoff, placemark, tuple(exclusions), trace_memory, block_workers)
+    workers = min(workers or os.cpu_count() or 1, max(len(files), 1))
+    if workers <= 1:
+        for path in files:
+            yield run(path, *arguments)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run, path, *arguments) for path in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class CsvWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.writer = csv.DictWriter(stream, fieldnames=FIELDS, restval="")
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+
+class JsonLinesWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, row):
+        self.stream.write(json.dumps(row) + "\n")
+
+
+WRITERS = {"csv": CsvWriter, "jsonl": JsonLinesWriter}
+
+
+def output_format(path, requested=None):
+    # An explicit --format wins, otherwise go by the file extension
+    if requested:
+        return requested
+    return "jsonl" if path.lower().endswith((".jsonl", ".json", ".ndjson")) else "csv"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Estimate survey km and ground points for many KML files.")
+    parser.add_argument("inputs", nargs="+", help="KML/KMZ files, directories of them or glob patterns")
+    parser.add_argument("--line-spacing", type=float, nargs="+", default=[400])
+    parser.add_argument("--angle", type=float, nargs="+", default=[0])
+    parser.add_argument("--margin", type=float, nargs="+", default=[0])
+    parser.add_argument("--ground-distance", type=float, nargs="+", default=[1000])
+    parser.add_argument("--cross-line-spacing", type=float, nargs="+", default=[500])
+    parser.add_argument("--fit-to-polygon", action="store_true", help="fit the grid to the rotated polygon")
+    parser.add_argument("--per-block", action="store_true", help="also write one row per polygon block")
+    parser.add_argument("--placemark", metavar="NAME", help="only plan the placemarks of this name in every file")
+    parser.add_argument(
+        "--exclusions",
+        nargs="+",
+        default=[],
+        metavar="KML",
+        help="no-fly zones and other areas to cut out of the lines, as KML/KMZ polygons",
+    )
+    parser.add_argument("--endurance", type=float, help="split the route into sorties of at most this many km")
+    parser.add_argument(
+        "--takeoff", type=float, nargs=2, metavar=("LON", "LAT"), help="sortie take-off point (default: area centre)"
+    )
+    parser.add_argument("-o", "--output", default="-", help="output file, '-' for stdout (default)")
+    parser.add_argument("--format", choices=sorted(WRITERS), help="output format (default: from the extension)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: all CPUs)")
+    parser.add_argument(
+        "--block-workers",
+        type=int,
+        default=1,
+        metavar="N",
+        help="plan the blocks of each file in N processes, for few files of many blocks (default: 1)",
+    )
+    parser.add_argument("--diagnostics", metavar="JSON", help="write per-file stage timings and counters to JSON")
+    parser.add_argument(
+        "--trace-memory", action="store_true", help="measure peak memory with tracemalloc (slower) in the diagnostics"
+    )
+    parser.add_argument("--cprofile", metavar="PROF", help="dump a cProfile of the run, planned in this process")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    files = find_kml_files(args.inputs)
+    if not files:
+        print("No KML files found.", file=sys.stderr)
+        return 1
+    try:
+        grid = parameter_grid(
+            args.line_spacing,
+            args.angle,
+            args.margin,
+            args.ground_distance,
+            args.cross_line_spacing,
+            args.fit_to_polygon,
+        )
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    if args.endurance is not None and args.endurance <= 0:
+        print("Endurance must be greater than zero.", file=sys.stderr)
+        return 2
+
+    # cProfile only sees this process, so profiled runs plan here
+    workers = 1 if args.cprofile else args.workers
+    block_workers = 1 if args.cprofile else args.block_workers
+    diagnose = bool(args.diagnostics)
+    reports = []
+    start = time.perf_counter()
+    stream = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    try:
+        writer = WRITERS[output_format(args.output, args.format)](stream)
+        failed = 0
+        results = estimate_files(
+            files,
+            grid,
+            workers,
+            args.per_block,
+            args.endurance,
+            args.takeoff,
+            diagnose,
+            args.trace_memory,
+            placemark=args.placemark,
+            exclusions=args.exclusions,
+            block_workers=block_workers,
+        )
+        with profiled(args.cprofile) if args.cprofile else contextlib.nullcontext():
+            for rows, report in results:
+                for row in rows:
+                    writer.write(row)
+                    failed += bool(row["error"])
+                if report is not None:
+                    reports.append(report)
+                # Results appear as each file finishes
+                stream.flush()
+    finally:
+        if stream is not sys.stdout:
+            stream.close()
+
+    if diagnose:
+        with open(args.diagnostics, "w") as report_file:
+            json.dump(
+                {
+                    "wall_seconds": round(time.perf_counter() - start, 6),
+                    "workers": workers,
+                    "block_workers": block_workers,
+                    "files": reports,
+                    "total": merge_snapshots(reports),
+                },
+                report_file,
+                indent=2,
+            )
+
+    print(f"Estimated {len(files)} file(s) x {len(grid)} parameter set(s), {failed} failed.", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+"""Memoised survey plans for MKE.
+
+Estimators flip between a handful of spacings and angles, so finished plans
+are kept in a bounded LRU cache keyed on the polygon, the parameters and the
+exclusion layer, if any. An
+optional directory of .npz files keeps them across app restarts as well.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from dataclasses import astuple
+
+import numpy as np
+import shapely
+
+from mke_engine import SurveyPlan, plan_survey
+from mke_profile import diagnostics
+
+# Bump whenever the planning engine changes its results, so stale plans on
+# disk are never returned
+CACHE_VERSION = 5
+
+_ARRAY_FIELDS = ("main_lines", "cross_lines", "main_line_ids", "cross_line_ids")
+_TOTAL_FIELDS = (
+    "main_line_count",
+    "cross_line_count",
+    "main_length_km",
+    "cross_length_km",
+    "excluded_km",
+    "total_points",
+)
+
+
+def polygon_hash(polygon):
+    # Stable digest of the polygon geometry, independent of the Python object
+    return hashlib.sha1(shapely.to_wkb(polygon, output_dimension=2, byte_order=1)).hexdigest()
+
+
+class PlanCache:
+    """LRU cache of survey plans, optionally backed by a directory on disk.
+
+    ``max_size`` bounds the plans held in memory. With ``directory`` set,
+    every plan is also written there, and at most ``max_disk_entries`` files
+    are kept, dropping the least recently used first. The cache can be
+    shared between a GUI thread and a background planning thread.
+    """
+
+    def __init__(self, max_size=32, directory=None, max_disk_entries=1000):
+        self.max_size = max_size
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._plans = OrderedDict()
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self._plans)
+
+    def key(self, polygon, parameters, exclusions=None):
+        # Floats throughout, so 400 and 400.0 share an entry on disk as well
+        key = (CACHE_VERSION, polygon_hash(polygon)) + tuple(float(value) for value in astuple(parameters))
+        return key if exclusions is None else key + (exclusions.digest,)
+
+    def get(self, polygon, parameters, exclusions=None):
+        key = self.key(polygon, parameters, exclusions)
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self._plans.move_to_end(key)
+                return plan
+        plan = self._load(key, parameters)
+        if plan is not None:
+            self._remember(key, plan)
+        return plan
+
+    def put(self, polygon, parameters, plan, exclusions=None):
+        key = self.key(polygon, parameters, exclusions)
+        self._remember(key, plan)
+        self._save(key, plan)
+
+    def plan(self, polygon, parameters, planner=plan_survey, exclusions=None):
+        # Return the cached plan, or compute it with ``planner`` and keep it.
+        # The planner is called as planner(polygon, parameters, exclusions=...)
+        plan = self.get(polygon, parameters, exclusions)
+        if plan is None:
+            diagnostics.count("cache_misses")
+            plan = planner(polygon, parameters, exclusions=exclusions)
+            self.put(polygon, parameters, plan, exclusions)
+        else:
+            diagnostics.count("cache_hits")
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+    def _remember(self, key, plan):
+        with self._lock:
+            self._plans[key] = plan
+            self._plans.move_to_end(key)
+            while len(self._plans) > self.max_size:
+                self._plans.popitem(last=False)
+
+    def _path(self, key):
+        name = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def _load(self, key, parameters):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+
+                def load_plan(prefix, blocks=()):
+                    arrays = {name: data[prefix + name] for name in _ARRAY_FIELDS}
+                    totals = {name: data[prefix + name].item() for name in _TOTAL_FIELDS}
+                    return SurveyPlan(parameters=parameters, blocks=list(blocks), **arrays, **totals)
+
+                blocks = [load_plan(f"block{index}_") for index in range(data["block_count"].item())]
+                plan = load_plan("", blocks)
+        except (OSError, KeyError, ValueError):
+            return None
+        # Mark the file as recently used for the on-disk eviction
+        os.utime(path)
+        return plan
+
+    def _save(self, key, plan):
+        if not self.directory:
+            return
+        # The plan itself, then each of its blocks under a "block<n>_" prefix
+        values = {"block_count": len(plan.blocks)}
+        stored_plans = [("", plan)] + [(f"block{index}_", block) for index, block in enumerate(plan.blocks)]
+        for prefix, stored_plan in stored_plans:
+            values.update({prefix + name: getattr(stored_plan, name) for name in _ARRAY_FIELDS + _TOTAL_FIELDS})
+        # Write to a temporary file first so a crash never leaves a half-written plan
+        handle, temp_path = tempfile.mkstemp(suffix=".npz", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as temp_file:
+                np.savez(temp_file, **values)
+            os.replace(temp_path, self._path(key))
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self._prune()
+
+    def _prune(self):
+        entries = [
+            os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz")
+        ]
+        if len(entries) <= self.max_disk_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[: len(entries) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
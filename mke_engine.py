@@ -0,0 +1,718 @@
+"""GUI-free survey planning engine for MKE.
+
+Everything in here works on shapely geometries and NumPy arrays only, so it
+can be imported by the Qt front end, batch scripts or a quoting server without
+starting Qt or matplotlib. All coordinates are projected (UTM) metres.
+"""
+import hashlib
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass, field
+
+import numpy as np
+import shapely
+import shapely.affinity
+
+from mke_profile import diagnostics
+
+
+@dataclass(frozen=True)
+class SurveyParameters:
+    # Defaults match the placeholders shown in the MKE input form
+    line_spacing: float = 400
+    angle: float = 0
+    margin: float = 0
+    ground_distance: float = 1000
+    cross_line_spacing: float = 500
+    # Fit the grid to the rotated survey polygon instead of a large buffer around it
+    fit_to_polygon: bool = False
+
+    def validate(self):
+        if self.line_spacing <= 0:
+            raise ValueError("Line spacing must be greater than zero.")
+        if self.cross_line_spacing <= 0:
+            raise ValueError("Cross line spacing must be greater than zero.")
+        if self.ground_distance <= 0:
+            raise ValueError("Ground distance must be greater than zero.")
+
+
+@dataclass
+class SurveyPlan:
+    # Clipped segments as (n, 2, 2) arrays of [start, end] points
+    main_lines: np.ndarray
+    cross_lines: np.ndarray
+    # Index of the generated grid line each segment was clipped from
+    main_line_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=int))
+    cross_line_ids: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=int))
+    main_line_count: int = 0
+    cross_line_count: int = 0
+    main_length_km: float = 0.0
+    cross_length_km: float = 0.0
+    # Line km cut out of the main and cross lines by the exclusion zones
+    excluded_km: float = 0.0
+    # Number of ground survey stations along the main lines
+    total_points: int = 0
+    parameters: SurveyParameters = field(default_factory=SurveyParameters)
+    # Per-block plans, when this plan combines a survey area of several blocks
+    blocks: list = field(default_factory=list)
+
+    @property
+    def total_length_km(self):
+        return self.main_length_km + self.cross_length_km
+
+
+def _geos(geometry, calls=1):
+    # Count a GEOS operation and the geometries it returned, then pass them on
+    diagnostics.count("geos_calls", calls)
+    diagnostics.count("geometries_created", np.size(geometry) if isinstance(geometry, np.ndarray) else 1)
+    return geometry
+
+
+def _rotate_coords(coords, angle, origin):
+    # Rotate an array of (..., 2) coordinates counter-clockwise by ``angle``
+    # degrees about ``origin``, the same convention as shapely.affinity.rotate
+    theta = np.radians(angle)
+    cos_a, sin_a = np.cos(theta), np.sin(theta)
+    x0, y0 = origin
+    dx = coords[..., 0] - x0
+    dy = coords[..., 1] - y0
+    return np.stack([x0 + cos_a * dx - sin_a * dy, y0 + sin_a * dx + cos_a * dy], axis=-1)
+
+
+def ranges(counts):
+    # For a run of counts [2, 3] return the owner of every item [0, 0, 1, 1, 1]
+    # and its offset within the owner [0, 1, 0, 1, 2]
+    owner = np.repeat(np.arange(len(counts)), counts)
+    offset = np.arange(len(owner)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, offset
+
+
+def segment_lengths(segments):
+    # Length of each (start, end) segment in metres
+    return np.hypot(*(segments[:, 1] - segments[:, 0]).T) if len(segments) else np.zeros(0)
+
+
+def grid_positions(bounds, line_spacing, cross_line_spacing, centred=False):
+    """Place the main and cross lines of the grid over ``bounds``.
+
+    Main lines run south-north every ``line_spacing`` and are returned as
+    their x coordinates. By default they start at the western edge and span
+    the diagonal of the box; with ``centred`` they span just its width and
+    are centred on it. Cross lines run west-east from the middle of the box,
+    then alternately above and below it, and are returned as their y
+    coordinates.
+    """
+    minx, miny, maxx, maxy = bounds
+    if centred:
+        num_lines = int((maxx - minx) / line_spacing) + 1
+        x_coords = (minx + maxx) / 2 + (np.arange(num_lines) - (num_lines - 1) / 2) * line_spacing
+    else:
+        num_lines = int(np.hypot(maxx - minx, maxy - miny) / line_spacing)
+        x_coords = minx + np.arange(num_lines) * line_spacing
+
+    mid_y = (miny + maxy) / 2
+    num_cross_lines = int(min(mid_y - miny, maxy - mid_y) / cross_line_spacing)
+    steps = np.arange(1, num_cross_lines + 1) * cross_line_spacing
+    y_coords = mid_y + np.concatenate([[0.0], np.column_stack([steps, -steps]).ravel()])
+    return x_coords, y_coords
+
+
+def _polygon_edges(region, return_part=False):
+    # Every edge of every ring (exterior and holes) of a (multi)polygon, and
+    # with ``return_part`` the index of the polygon each edge belongs to
+    parts = _geos(shapely.get_parts(region))
+    parts = parts[shapely.get_type_id(parts) == shapely.GeometryType.POLYGON]
+    rings, part_index = shapely.get_rings(parts, return_index=True)
+    coords, ring_index = shapely.get_coordinates(_geos(rings), return_index=True)
+    diagnostics.count("geos_calls")
+    same_ring = ring_index[1:] == ring_index[:-1]
+    if return_part:
+        return coords[:-1][same_ring], coords[1:][same_ring], part_index[ring_index[:-1][same_ring]]
+    return coords[:-1][same_ring], coords[1:][same_ring]
+
+
+def _merge_spans(line, start, end):
+    # Union of the [start, end] spans on each line, joining spans that touch.
+    # Sweeping +1/-1 events sorted by line then position returns to depth 0
+    # at the end of every merged span, and at the end of every line.
+    steps = np.repeat([1, -1], len(line))
+    line = np.concatenate([line, line])
+    position = np.concatenate([start, end])
+    order = np.lexsort((-steps, position, line))
+    line, position, steps = line[order], position[order], steps[order]
+    depth = np.cumsum(steps)
+    opens = (steps == 1) & (depth == 1)
+    closes = depth == 0
+    return line[opens], position[opens], position[closes]
+
+
+def clip_lines(positions, region, axis=0, per_part=False):
+    """Clip a family of axis-aligned lines to ``region`` in one scanline sweep.
+
+    With ``axis=0`` the lines are ``x = position`` running south-north, with
+    ``axis=1`` they are ``y = position`` running west-east. Every ring edge is
+    matched to the lines it spans with a binary search, the crossings are
+    sorted along each line and paired up inside/outside, so the cost grows
+    with edges + crossings rather than lines * edges.
+
+    With ``per_part`` the crossings are paired up within each polygon of
+    ``region`` on its own, so polygons may overlap one another, as the
+    polygons of an exclusion layer do.
+
+    Returns the inside spans as an (m, 2, 2) array of [start, end] points and
+    the index into ``positions`` of the line each span lies on.
+    """
+    positions = np.asarray(positions, dtype=float)
+    starts, ends, part = _polygon_edges(region, return_part=True)
+    if not len(positions) or not len(starts):
+        return np.empty((0, 2, 2)), np.empty(0, dtype=int)
+
+    # u runs across the lines, v along them
+    u1, v1 = starts[:, axis], starts[:, 1 - axis]
+    u2, v2 = ends[:, axis], ends[:, 1 - axis]
+    order = np.argsort(positions, kind="stable")
+    sorted_positions = positions[order]
+
+    # Half-open spans count a line through a shared vertex exactly once, so
+    # every line meets each closed ring an even number of times
+    first = np.searchsorted(sorted_positions, np.minimum(u1, u2), side="left")
+    last = np.searchsorted(sorted_positions, np.maximum(u1, u2), side="left")
+    edge, offsets = ranges(last - first)
+    line = first[edge] + offsets
+
+    u = sorted_positions[line]
+    v = v1[edge] + (u - u1[edge]) * (v2[edge] - v1[edge]) / (u2[edge] - u1[edge])
+
+    crossing_order = np.lexsort((v, part[edge], line) if per_part else (v, line))
+    line, v = line[crossing_order], v[crossing_order]
+    line, v_start, v_end = line[0::2], v[0::2], v[1::2]
+
+    # Edges lying exactly on a line belong to the (closed) polygon as well
+    on_line = u1 == u2
+    if on_line.any():
+        index = np.minimum(np.searchsorted(sorted_positions, u1[on_line]), len(sorted_positions) - 1)
+        hit = sorted_positions[index] == u1[on_line]
+        line = np.concatenate([line, index[hit]])
+        v_start = np.concatenate([v_start, np.minimum(v1, v2)[on_line][hit]])
+        v_end = np.concatenate([v_end, np.maximum(v1, v2)[on_line][hit]])
+
+    keep = v_end > v_start
+    line, v_start, v_end = _merge_spans(line[keep], v_start[keep], v_end[keep])
+    u = sorted_positions[line]
+
+    diagnostics.count("segments_clipped", len(line))
+    segments = np.empty((len(line), 2, 2))
+    segments[:, :, axis] = u[:, None]
+    segments[:, 0, 1 - axis] = v_start
+    segments[:, 1, 1 - axis] = v_end
+    return segments, order[line]
+
+
+def touching_lines(positions, region, axis=0):
+    """Index into ``positions`` of the lines that pass exactly through a
+    vertex of ``region``.
+
+    A line that only touches the polygon at a vertex gets no span from
+    clip_lines, but it does meet the polygon and is counted as a line, as
+    the original planner counted it.
+    """
+    starts, _ = _polygon_edges(region)
+    return np.flatnonzero(np.isin(np.asarray(positions, dtype=float), starts[:, axis]))
+
+
+def _clip_and_count(positions, region, axis):
+    # clip_lines plus the index of every line meeting the region, touching lines included
+    segments, line_ids = clip_lines(positions, region, axis)
+    return segments, line_ids, np.union1d(line_ids, touching_lines(positions, region, axis))
+
+
+def exclude_lines(segments, line_ids, region, axis=0):
+    """Cut the parts of ``segments`` lying inside ``region`` out of them.
+
+    ``segments`` and ``line_ids`` are as returned by :func:`clip_lines` for
+    lines along ``axis``, and ``region`` holds the exclusion polygons in the
+    same frame, overlapping or not. Only the lines carrying segments are
+    swept against the exclusions, so the cost grows with those lines and the
+    exclusion edges they meet. The spans left over are returned the same way,
+    in the same line order.
+    """
+    if not len(segments):
+        return segments, line_ids
+    # Every distinct line once, in position order like the segments themselves
+    positions, line = np.unique(segments[:, 0, axis], return_inverse=True)
+    ids = np.empty(len(positions), dtype=int)
+    ids[line] = line_ids
+    cuts, cut_line = clip_lines(positions, region, axis, per_part=True)
+    diagnostics.count("exclusion_spans", len(cuts))
+    if not len(cuts):
+        return segments, line_ids
+
+    # Sweep the segment and cut ends along every line, keeping the stretches
+    # inside a segment and outside every cut
+    spans = np.concatenate([segments, cuts])[:, :, 1 - axis]
+    is_cut = np.tile(np.arange(len(spans)) >= len(segments), 2)
+    steps = np.repeat([1, -1], len(spans))
+    line = np.tile(np.concatenate([line, cut_line]), 2)
+    position = np.concatenate([spans[:, 0], spans[:, 1]])
+    inside, excluded = np.where(is_cut, 0, steps), np.where(is_cut, steps, 0)
+    order = np.lexsort((position, line))
+    line, position = line[order], position[order]
+    inside, excluded = np.cumsum(inside[order]), np.cumsum(excluded[order])
+    keep = (
+        (inside[:-1] > 0) & (excluded[:-1] == 0) & (line[1:] == line[:-1]) & (position[1:] > position[:-1])
+    )
+    # Stretches split only by a cut touching the line at a point are joined again
+    line, v_start, v_end = _merge_spans(line[:-1][keep], position[:-1][keep], position[1:][keep])
+
+    kept = np.empty((len(line), 2, 2))
+    kept[:, :, axis] = positions[line][:, None]
+    kept[:, 0, 1 - axis] = v_start
+    kept[:, 1, 1 - axis] = v_end
+    return kept, ids[line]
+
+
+def _exclude_and_count(segments, line_ids, counted_ids, region, axis):
+    # exclude_lines, plus the counted lines minus those excluded end to end,
+    # and the metres cut out
+    kept, kept_ids = exclude_lines(segments, line_ids, region, axis)
+    gone = np.setdiff1d(line_ids, kept_ids)
+    excluded = float(segment_lengths(segments).sum() - segment_lengths(kept).sum())
+    return kept, kept_ids, np.setdiff1d(counted_ids, gone), excluded
+
+
+def point_counts(segments, ground_distance):
+    """Number of ground points on each segment, ``floor(length / ground_distance)``.
+
+    A tiny tolerance keeps lengths that are an exact multiple of the ground
+    distance from losing a point to floating point noise.
+    """
+    return np.floor(segment_lengths(segments) / ground_distance + 1e-9).astype(int)
+
+
+@diagnostics.timed("ground_points")
+def ground_points(segments, ground_distance):
+    """Place the ground points along every segment as one (n, 2) array.
+
+    Each segment gets ``point_counts`` points spread evenly from its start to
+    its end, both ends included, in segment order.
+    """
+    counts = point_counts(segments, ground_distance)
+    diagnostics.count("ground_points_built", counts.sum())
+    segment, step = ranges(counts)
+    fraction = step / np.maximum(counts - 1, 1)[segment]
+    starts = segments[segment, 0]
+    return starts + fraction[:, None] * (segments[segment, 1] - starts)
+
+
+class ExclusionLayer:
+    """No-fly zones, power line corridors, built-up areas and any other
+    polygons the survey lines must leave out.
+
+    ``polygons`` may mix Polygons and MultiPolygons, in the projected metres
+    of the survey area. They are held in an STRtree, so every block only
+    sweeps its lines against the exclusions near it. ``digest`` identifies
+    the layer by its geometry, for cache keys, and is computed once here.
+    Layers with the same digest compare equal.
+    """
+
+    def __init__(self, polygons):
+        self.polygons = np.array(survey_blocks(np.array(list(polygons), dtype=object)), dtype=object)
+        self.tree = shapely.STRtree(self.polygons)
+        digest = hashlib.sha1()
+        for wkb in shapely.to_wkb(self.polygons, output_dimension=2, byte_order=1):
+            digest.update(wkb)
+        self.digest = digest.hexdigest()
+
+    def __eq__(self, other):
+        return isinstance(other, ExclusionLayer) and other.digest == self.digest
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __getstate__(self):
+        # The tree is rebuilt from the polygons in worker processes
+        return self.polygons, self.digest
+
+    def __setstate__(self, state):
+        self.polygons, self.digest = state
+        self.tree = shapely.STRtree(self.polygons)
+
+    def near(self, geometry):
+        # The exclusions intersecting ``geometry``
+        nearby = self.polygons[self.tree.query(geometry, predicate="intersects")]
+        diagnostics.count("exclusions_nearby", len(nearby))
+        return nearby
+
+    def around(self, geometry):
+        # The exclusions intersecting ``geometry`` as a layer of their own. It
+        # keeps this layer's digest, as it plans the same near ``geometry``,
+        # and is cheap to send to a worker process
+        layer = ExclusionLayer.__new__(ExclusionLayer)
+        layer.__setstate__((self.polygons[self.tree.query(geometry, predicate="intersects")], self.digest))
+        return layer
+
+
+def exclusion_reach(polygon, margin):
+    # The box around ``polygon`` and its margin within which exclusions can cut its lines
+    minx, miny, maxx, maxy = polygon.bounds
+    reach = max(margin, 0)
+    return shapely.box(minx - reach, miny - reach, maxx + reach, maxy + reach)
+
+
+class PlanCancelled(Exception):
+    # Raised by a progress callback to abandon a plan part way through
+    pass
+
+
+# Pipeline stages in the order they finish, used to report progress
+_STAGES = (
+    "grid_window",
+    "window_centroid",
+    "polygon_centroid",
+    "survey_area",
+    "grid",
+    "main_clip",
+    "margin_area",
+    "margin_clip",
+    "cross_clip",
+    "exclusion_area",
+    "main_exclude",
+    "cross_exclude",
+    "main_lines",
+    "cross_lines",
+    "points",
+    "main_length",
+    "cross_length",
+    "plan",
+)
+
+
+class SurveyPipeline:
+    """Plans a polygon stage by stage, keeping every stage's last result.
+
+    Each stage is keyed on the parameters it actually depends on, so editing
+    one input only reruns the stages downstream of it: a new ground distance
+    only recounts points, a new cross line spacing only re-clips the cross
+    lines, and so on. Passing a different polygon drops everything. A new
+    exclusion layer only reruns the stages from the exclusion cuts onwards.
+
+    ``progress``, when given to :meth:`plan`, is called as
+    ``progress(fraction, stage)`` after every stage that had to be computed.
+    It may raise :class:`PlanCancelled` to stop planning; the stages finished
+    so far are kept.
+    """
+
+    def __init__(self):
+        self.polygon = None
+        self.progress = None
+        self._stages = {}
+
+    def _stage(self, name, key, compute):
+        cached = self._stages.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with diagnostics.timer(f"pipeline.{name}"):
+            value = compute()
+        self._stages[name] = (key, value)
+        if self.progress is not None:
+            self.progress((_STAGES.index(name) + 1) / len(_STAGES), name)
+        return value
+
+    def _grid_window(self):
+        # The default grid is laid out inside a generously buffered polygon so
+        # it still covers the survey area after rotation
+        return self._stage(
+            "grid_window", None, lambda: _geos(self.polygon.buffer(np.sqrt(self.polygon.area) * 2))
+        )
+
+    def _origin(self, fit_to_polygon):
+        if fit_to_polygon:
+            return self._stage("polygon_centroid", None, lambda: _geos(self.polygon.centroid))
+        return self._stage("window_centroid", None, lambda: _geos(self._grid_window().centroid))
+
+    def _grid_frame(self, area, angle, fit_to_polygon):
+        # Rotate an area into the frame of the unrotated grid: rotating the
+        # polygons by -angle once replaces rotating every line by +angle
+        area = _geos(shapely.affinity.rotate(area, -angle, origin=self._origin(fit_to_polygon)))
+        return area if fit_to_polygon else _geos(self._grid_window().intersection(area))
+
+    def _exclusion_frame(self, exclusions, margin, angle, fit_to_polygon):
+        # The exclusions near the polygon and its margin, rotated into the grid
+        # frame. The lines never leave the grid window, so it needs no clipping
+        nearby = exclusions.near(exclusion_reach(self.polygon, margin))
+        return _geos(
+            shapely.affinity.rotate(shapely.MultiPolygon(list(nearby)), -angle, origin=self._origin(fit_to_polygon))
+        )
+
+    def has_plan(self, polygon, parameters, exclusions=None):
+        # Whether planning ``polygon`` again would return the last plan as it is
+        cached = self._stages.get("plan")
+        return polygon is self.polygon and cached is not None and cached[0] == (parameters, exclusions)
+
+    def plan(self, polygon, parameters=None, progress=None, exclusions=None):
+        parameters = parameters or SurveyParameters()
+        parameters.validate()
+        if polygon is not self.polygon:
+            self.polygon = polygon
+            self._stages.clear()
+
+        # The whole plan is reused when nothing changed at all
+        self.progress = progress
+        try:
+            return self._stage(
+                "plan", (parameters, exclusions), lambda: self._build_plan(parameters, exclusions)
+            )
+        finally:
+            self.progress = None
+
+    def _build_plan(self, parameters, exclusions):
+        p = parameters
+        frame_key = (p.fit_to_polygon, p.angle)
+        main_key = frame_key + (p.line_spacing,)
+        trim_key = main_key + (p.margin,)
+        cross_key = frame_key + (p.cross_line_spacing,)
+        # The lines actually flown, after the exclusion cuts
+        flown_key = trim_key + (exclusions,)
+        cross_flown_key = cross_key + (exclusions,)
+
+        survey_area = self._stage(
+            "survey_area", frame_key, lambda: self._grid_frame(self.polygon, p.angle, p.fit_to_polygon)
+        )
+
+        def grid():
+            # The default grid covers the buffered window, the fitted one the rotated polygon only
+            if p.fit_to_polygon:
+                return grid_positions(survey_area.bounds, p.line_spacing, p.cross_line_spacing, centred=True)
+            return grid_positions(self._grid_window().bounds, p.line_spacing, p.cross_line_spacing)
+
+        x_coords, y_coords = self._stage("grid", main_key + (p.cross_line_spacing,), grid)
+
+        main_lines, main_ids, main_line_ids = self._stage(
+            "main_clip", main_key, lambda: _clip_and_count(x_coords, survey_area, axis=0)
+        )
+        if p.margin:
+            # Lines are selected by the survey polygon but trimmed to the margin polygon
+            margin_area = self._stage(
+                "margin_area",
+                frame_key + (p.margin,),
+                lambda: self._grid_frame(_geos(self.polygon.buffer(p.margin)), p.angle, p.fit_to_polygon),
+            )
+
+            def trim():
+                trimmed, margin_ids = clip_lines(x_coords[main_line_ids], margin_area, axis=0)
+                return trimmed, main_line_ids[margin_ids]
+
+            main_lines, main_ids = self._stage("margin_clip", trim_key, trim)
+        cross_lines, cross_ids, cross_line_ids = self._stage(
+            "cross_clip", cross_key, lambda: _clip_and_count(y_coords, survey_area, axis=1)
+        )
+        main_excluded = cross_excluded = 0.0
+        if exclusions is not None:
+            exclusion_area = self._stage(
+                "exclusion_area",
+                frame_key + (p.margin, exclusions),
+                lambda: self._exclusion_frame(exclusions, p.margin, p.angle, p.fit_to_polygon),
+            )
+            main_lines, main_ids, main_line_ids, main_excluded = self._stage(
+                "main_exclude",
+                flown_key,
+                lambda: _exclude_and_count(main_lines, main_ids, main_line_ids, exclusion_area, 0),
+            )
+            cross_lines, cross_ids, cross_line_ids, cross_excluded = self._stage(
+                "cross_exclude",
+                cross_flown_key,
+                lambda: _exclude_and_count(cross_lines, cross_ids, cross_line_ids, exclusion_area, 1),
+            )
+
+        # Only the surviving segments are rotated back
+        origin = self._origin(p.fit_to_polygon).coords[0]
+        main_lines = self._stage("main_lines", flown_key, lambda: _rotate_coords(main_lines, p.angle, origin))
+        cross_lines = self._stage(
+            "cross_lines", cross_flown_key, lambda: _rotate_coords(cross_lines, p.angle, origin)
+        )
+        total_points = self._stage(
+            "points", flown_key + (p.ground_distance,), lambda: int(point_counts(main_lines, p.ground_distance).sum())
+        )
+
+        return SurveyPlan(
+            main_lines=main_lines,
+            cross_lines=cross_lines,
+            main_line_ids=main_ids,
+            cross_line_ids=cross_ids,
+            main_line_count=len(main_line_ids),
+            cross_line_count=len(cross_line_ids),
+            main_length_km=self._stage(
+                "main_length", flown_key, lambda: float(segment_lengths(main_lines).sum()) / 1000
+            ),
+            cross_length_km=self._stage(
+                "cross_length", cross_flown_key, lambda: float(segment_lengths(cross_lines).sum()) / 1000
+            ),
+            excluded_km=(main_excluded + cross_excluded) / 1000,
+            total_points=total_points,
+            parameters=parameters,
+        )
+
+
+def _plan_block(pipeline, block, parameters, exclusions):
+    # Plan one block in a worker process. The pipeline goes back with its
+    # stages, for the next edit, along with the diagnostics of the work
+    diagnostics.reset()
+    pipeline.plan(block, parameters, exclusions=exclusions)
+    return pipeline, diagnostics.snapshot()
+
+
+class AreaPipeline:
+    """Incremental planner for survey areas made of one or more blocks.
+
+    Every block gets its own :class:`SurveyPipeline` and grid, and the block
+    plans are combined into one plan for the whole area.
+
+    With more than one ``workers`` the blocks that need planning are planned
+    in parallel processes, largest first, so an area of many blocks takes
+    about as long as its largest block; ``None`` uses every CPU. Each block
+    travels with its pipeline and only the exclusions near it, and the
+    pipeline comes back, so later edits stay incremental. The processes are
+    spawned on first use and kept until :meth:`close`.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.area = None
+        self.pipelines = []
+        self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Stop the worker processes, if any were started
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def plan(self, area, parameters=None, progress=None, exclusions=None):
+        parameters = parameters or SurveyParameters()
+        parameters.validate()
+        if area is not self.area:
+            self.area = area
+            self.pipelines = [(block, SurveyPipeline()) for block in survey_blocks(area)]
+
+        pending = [
+            index
+            for index, (block, pipeline) in enumerate(self.pipelines)
+            if not pipeline.has_plan(block, parameters, exclusions)
+        ]
+        if len(pending) > 1 and (self.workers or os.cpu_count() or 1) > 1:
+            self._plan_in_workers(pending, parameters, progress, exclusions)
+
+        def block_progress(index):
+            # Scale each block's progress into its share of the whole area
+            if progress is None:
+                return None
+            return lambda fraction, stage: progress((index + fraction) / len(self.pipelines), stage)
+
+        return combine_plans(
+            [
+                pipeline.plan(block, parameters, block_progress(index), exclusions)
+                for index, (block, pipeline) in enumerate(self.pipelines)
+            ],
+            parameters,
+        )
+
+    def _plan_in_workers(self, indices, parameters, progress, exclusions):
+        # Plan the blocks at ``indices`` in the worker processes. ``progress``
+        # is called as blocks finish and every 0.1 s meanwhile, so it can
+        # raise PlanCancelled; the blocks not started yet are then dropped
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers or os.cpu_count(), mp_context=multiprocessing.get_context("spawn")
+            )
+        # Start the largest blocks first so the wall time tracks the largest block
+        futures = {}
+        for index in sorted(indices, key=lambda index: self.pipelines[index][0].area, reverse=True):
+            block, pipeline = self.pipelines[index]
+            nearby = None if exclusions is None else exclusions.around(exclusion_reach(block, parameters.margin))
+            futures[self._executor.submit(_plan_block, pipeline, block, parameters, nearby)] = index
+
+        pending = set(futures)
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pipeline, snapshot = future.result()
+                    block = self.pipelines[futures[future]][0]
+                    # The pipeline came back with a copy of the block
+                    pipeline.polygon = block
+                    self.pipelines[futures[future]] = (block, pipeline)
+                    diagnostics.merge(snapshot)
+                if progress is not None:
+                    progress((len(futures) - len(pending)) / len(futures), "blocks")
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def survey_blocks(area):
+    """Split a survey area into its separate blocks.
+
+    ``area`` may be a Polygon, a MultiPolygon or a GeometryCollection; the
+    non-empty polygons in it are returned as a list, holes included.
+    """
+    parts = shapely.get_parts(area)
+    while len(parts) and np.any(shapely.get_type_id(parts) >= shapely.GeometryType.MULTIPOINT):
+        parts = shapely.get_parts(parts)
+    polygons = parts[(shapely.get_type_id(parts) == shapely.GeometryType.POLYGON) & ~shapely.is_empty(parts)]
+    return list(polygons)
+
+
+def combine_plans(plans, parameters=None):
+    """Merge per-block plans into a single plan for the whole survey area.
+
+    Segments are concatenated in block order, line ids are offset so they
+    stay unique across blocks, and totals are summed. The block plans are
+    kept in ``blocks``. A single plan is returned as it is.
+    """
+    parameters = parameters or SurveyParameters()
+    if len(plans) == 1:
+        return plans[0]
+
+    def stacked_ids(name):
+        ids, offset = [], 0
+        for plan in plans:
+            block_ids = getattr(plan, name)
+            ids.append(block_ids + offset)
+            offset += int(block_ids.max()) + 1 if len(block_ids) else 0
+        return np.concatenate(ids) if ids else np.empty(0, dtype=int)
+
+    return SurveyPlan(
+        main_lines=np.concatenate([plan.main_lines for plan in plans]) if plans else np.empty((0, 2, 2)),
+        cross_lines=np.concatenate([plan.cross_lines for plan in plans]) if plans else np.empty((0, 2, 2)),
+        main_line_ids=stacked_ids("main_line_ids"),
+        cross_line_ids=stacked_ids("cross_line_ids"),
+        main_line_count=sum(plan.main_line_count for plan in plans),
+        cross_line_count=sum(plan.cross_line_count for plan in plans),
+        main_length_km=sum(plan.main_length_km for plan in plans),
+        cross_length_km=sum(plan.cross_length_km for plan in plans),
+        excluded_km=sum(plan.excluded_km for plan in plans),
+        total_points=sum(plan.total_points for plan in plans),
+        parameters=parameters,
+        blocks=list(plans),
+    )
+
+
+def plan_survey(polygon, parameters=None, workers=1, exclusions=None):
+    """Lay out main lines, cross lines and ground points over ``polygon``.
+
+    ``polygon`` must be in projected metres and may hold several blocks
+    (a MultiPolygon); each block gets its own grid and the result combines
+    them. With more than one ``workers`` the blocks are planned in parallel
+    processes, largest first, and ``None`` uses every CPU. The lines are cut
+    where they cross the polygons of ``exclusions``, an
+    :class:`ExclusionLayer`. Returns a :class:`SurveyPlan`.
+    """
+    with AreaPipeline(workers) as pipeline:
+        return pipeline.plan(polygon, parameters, exclusions=exclusions)
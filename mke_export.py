@@ -0,0 +1,387 @@
+"""Plan export for MKE.
+
+Writes the survey lines and the ground points straight from a plan's segment
+arrays, chunk by chunk, so memory stays flat however many lines or stations
+there are. Every line keeps its plan order and carries its segment number,
+grid line id, kind (main or cross) and length in metres.
+
+Supported line outputs, picked from the file extension:
+
+* ``.kml``      - Google Earth / flight planning, WGS84
+* ``.geojson``  - GeoJSON FeatureCollection, WGS84
+* ``.gpkg``     - GeoPackage layer in the plan's UTM zone
+* ``.csv``      - start and end waypoints for the flight controller
+
+Supported ground point outputs:
+
+* ``.kml``      - one placemark per station, WGS84
+* ``.gpx``      - GPS waypoints for the ground crews, WGS84
+* ``.csv``      - stations with lon/lat and easting/northing
+* ``.npy``      - compact (n, 2) float64 easting/northing array in the plan's
+  UTM zone, written through a memory map; read it back with :func:`load_points`
+
+Sorties are written one layer per sortie, as KML folders or GeoPackage layers.
+"""
+import csv
+import json
+import os
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from mke_engine import ground_points, point_counts, segment_lengths
+from mke_io import WGS84, transform_coords
+from mke_profile import diagnostics
+from mke_route import MAIN
+
+CHUNK_SIZE = 10000
+
+LINE_FORMATS = {
+    ".kml": "kml",
+    ".geojson": "geojson",
+    ".json": "geojson",
+    ".gpkg": "gpkg",
+    ".csv": "csv",
+}
+
+POINT_FORMATS = {
+    ".kml": "kml",
+    ".gpx": "gpx",
+    ".csv": "csv",
+    ".npy": "npy",
+}
+
+SORTIE_FORMATS = {
+    ".kml": "kml",
+    ".gpkg": "gpkg",
+}
+
+# KML colours are aabbggrr, matching the blue and purple used in the plot
+_KML_STYLES = (
+    '<Style id="main"><LineStyle><color>ffff0000</color><width>2</width></LineStyle></Style>\n'
+    '<Style id="cross"><LineStyle><color>ff800080</color><width>2</width></LineStyle></Style>\n'
+)
+
+
+def export_format(path, formats=LINE_FORMATS):
+    # Output format from the file extension
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in formats:
+        raise ValueError(f"Unsupported export format '{extension}', use one of {', '.join(formats)}.")
+    return formats[extension]
+
+
+def line_chunks(plan, epsg, chunk_size=CHUNK_SIZE):
+    """Yield the plan's lines in plan order, main lines first, as chunks.
+
+    Each chunk is a dict of arrays: ``segment`` (1-based running number),
+    ``line_id``, ``kind``, ``length_m``, ``utm`` and ``lonlat`` coordinates of
+    shape (n, 2, 2).
+    """
+    segment = 1
+    for kind, lines, line_ids in (
+        ("main", plan.main_lines, plan.main_line_ids),
+        ("cross", plan.cross_lines, plan.cross_line_ids),
+    ):
+        for start in range(0, len(lines), chunk_size):
+            utm_coords = lines[start:start + chunk_size]
+            count = len(utm_coords)
+            yield {
+                "segment": np.arange(segment, segment + count),
+                "line_id": line_ids[start:start + chunk_size],
+                "kind": kind,
+                "length_m": segment_lengths(utm_coords),
+                "utm": utm_coords,
+                "lonlat": transform_coords(utm_coords.reshape(-1, 2), epsg, WGS84).reshape(-1, 2, 2),
+            }
+            segment += count
+
+
+def _records(chunk):
+    # One plain attribute dict per line of a chunk
+    for index in range(len(chunk["segment"])):
+        yield index, {
+            "segment": int(chunk["segment"][index]),
+            "line_id": int(chunk["line_id"][index]),
+            "kind": chunk["kind"],
+            "length_m": round(float(chunk["length_m"][index]), 3),
+        }
+
+
+def _write_kml(plan, path, epsg, name):
+    with open(path, "w", encoding="utf-8") as kml:
+        kml.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        kml.write(f"<name>{escape(name)}</name>\n{_KML_STYLES}")
+        for chunk in line_chunks(plan, epsg):
+            placemarks = []
+            for index, record in _records(chunk):
+                data = "".join(f'<Data name="{key}"><value>{value}</value></Data>' for key, value in record.items())
+                coords = " ".join(f"{lon:.8f},{lat:.8f}" for lon, lat in chunk["lonlat"][index])
+                placemarks.append(
+                    f"<Placemark><name>{record['kind'].title()} {record['segment']}</name>"
+                    f"<styleUrl>#{record['kind']}</styleUrl><ExtendedData>{data}</ExtendedData>"
+                    f"<LineString><coordinates>{coords}</coordinates></LineString></Placemark>\n"
+                )
+            kml.write("".join(placemarks))
+        kml.write("</Document>\n</kml>\n")
+
+
+def _write_geojson(plan, path, epsg, name):
+    with open(path, "w", encoding="utf-8") as geojson:
+        geojson.write(f'{{"type": "FeatureCollection", "name": {json.dumps(name)}, "features": [\n')
+        separator = ""
+        for chunk in line_chunks(plan, epsg):
+            for index, record in _records(chunk):
+                feature = {
+                    "type": "Feature",
+                    "properties": record,
+                    "geometry": {"type": "LineString", "coordinates": np.round(chunk["lonlat"][index], 8).tolist()},
+                }
+                geojson.write(separator + json.dumps(feature))
+                separator = ",\n"
+        geojson.write("\n]}\n")
+
+
+def _write_gpkg(plan, path, epsg, name):
+    import fiona
+
+    schema = {
+        "geometry": "LineString",
+        "properties": {"segment": "int", "line_id": "int", "kind": "str", "length_m": "float"},
+    }
+    with fiona.open(path, "w", driver="GPKG", layer=name, crs=f"EPSG:{epsg}", schema=schema) as layer:
+        for chunk in line_chunks(plan, epsg):
+            layer.writerecords(
+                {
+                    "geometry": {"type": "LineString", "coordinates": chunk["utm"][index].tolist()},
+                    "properties": record,
+                }
+                for index, record in _records(chunk)
+            )
+
+
+def _write_csv(plan, path, epsg, name):
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(
+            ["segment", "line_id", "kind", "length_m", "waypoint", "longitude", "latitude", "easting", "northing"]
+        )
+        for chunk in line_chunks(plan, epsg):
+            for index, record in _records(chunk):
+                for waypoint, label in enumerate(("start", "end")):
+                    lon, lat = chunk["lonlat"][index, waypoint]
+                    easting, northing = chunk["utm"][index, waypoint]
+                    writer.writerow(
+                        list(record.values())
+                        + [label, f"{lon:.8f}", f"{lat:.8f}", f"{easting:.3f}", f"{northing:.3f}"]
+                    )
+
+
+_LINE_WRITERS = {"kml": _write_kml, "geojson": _write_geojson, "gpkg": _write_gpkg, "csv": _write_csv}
+
+
+@diagnostics.timed("export.lines")
+def export_lines(plan, path, epsg, name="MKE survey lines"):
+    """Write the main and cross lines of ``plan`` to ``path``.
+
+    ``epsg`` is the UTM zone the plan was computed in. The format follows the
+    file extension, see :data:`LINE_FORMATS`. Returns the number of lines.
+    """
+    _LINE_WRITERS[export_format(path)](plan, path, epsg, name)
+    return len(plan.main_lines) + len(plan.cross_lines)
+
+
+def point_chunks(plan, epsg=None, chunk_size=CHUNK_SIZE):
+    """Yield the plan's ground points in segment order as chunks.
+
+    Points are only ever built for about ``chunk_size`` stations at a time,
+    whole segments per chunk. Each chunk is a dict of arrays: ``point``
+    (1-based running number), ``segment`` (as in :func:`line_chunks`),
+    ``line_id``, ``utm`` of shape (n, 2) and, when ``epsg`` is given,
+    ``lonlat`` of shape (n, 2).
+    """
+    segments = plan.main_lines
+    ground_distance = plan.parameters.ground_distance
+    counts = point_counts(segments, ground_distance)
+    ends = np.cumsum(counts)
+    # Segment boundaries closest to every multiple of the chunk size
+    cuts = np.searchsorted(ends, np.arange(chunk_size, ends[-1] if len(ends) else 0, chunk_size), side="right")
+    bounds = np.unique(np.concatenate([[0], cuts, [len(segments)]]))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        chunk_counts = counts[start:stop]
+        if not chunk_counts.sum():
+            continue
+        first = ends[start] - chunk_counts[0]
+        utm_coords = ground_points(segments[start:stop], ground_distance)
+        segment = np.repeat(np.arange(start, stop), chunk_counts)
+        chunk = {
+            "point": np.arange(first + 1, first + len(utm_coords) + 1),
+            "segment": segment + 1,
+            "line_id": plan.main_line_ids[segment],
+            "utm": utm_coords,
+        }
+        if epsg is not None:
+            chunk["lonlat"] = transform_coords(utm_coords, epsg, WGS84)
+        yield chunk
+
+
+def _write_points_kml(plan, path, epsg, name):
+    with open(path, "w", encoding="utf-8") as kml:
+        kml.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        kml.write(f"<name>{escape(name)}</name>\n")
+        for chunk in point_chunks(plan, epsg):
+            kml.write(
+                "".join(
+                    f"<Placemark><name>{point}</name><ExtendedData>"
+                    f'<Data name="segment"><value>{segment}</value></Data>'
+                    f'<Data name="line_id"><value>{line_id}</value></Data></ExtendedData>'
+                    f"<Point><coordinates>{lon:.8f},{lat:.8f}</coordinates></Point></Placemark>\n"
+                    for point, segment, line_id, (lon, lat) in zip(
+                        chunk["point"], chunk["segment"], chunk["line_id"], chunk["lonlat"]
+                    )
+                )
+            )
+        kml.write("</Document>\n</kml>\n")
+
+
+def _write_points_gpx(plan, path, epsg, name):
+    with open(path, "w", encoding="utf-8") as gpx:
+        gpx.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<gpx version="1.1" creator="MKE" xmlns="http://www.topografix.com/GPX/1/1">\n'
+            f"<metadata><name>{escape(name)}</name></metadata>\n"
+        )
+        for chunk in point_chunks(plan, epsg):
+            gpx.write(
+                "".join(
+                    f'<wpt lat="{lat:.8f}" lon="{lon:.8f}"><name>{point}</name>'
+                    f"<desc>Segment {segment}, line {line_id}</desc></wpt>\n"
+                    for point, segment, line_id, (lon, lat) in zip(
+                        chunk["point"], chunk["segment"], chunk["line_id"], chunk["lonlat"]
+                    )
+                )
+            )
+        gpx.write("</gpx>\n")
+
+
+def _write_points_csv(plan, path, epsg, name):
+    with open(path, "w", newline="") as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(["point", "segment", "line_id", "longitude", "latitude", "easting", "northing"])
+        for chunk in point_chunks(plan, epsg):
+            writer.writerows(
+                [point, segment, line_id, f"{lon:.8f}", f"{lat:.8f}", f"{easting:.3f}", f"{northing:.3f}"]
+                for point, segment, line_id, (lon, lat), (easting, northing) in zip(
+                    chunk["point"], chunk["segment"], chunk["line_id"], chunk["lonlat"], chunk["utm"]
+                )
+            )
+
+
+def _write_points_npy(plan, path, epsg, name):
+    # The array is sized up front and filled through a memory map, chunk by chunk
+    total = int(point_counts(plan.main_lines, plan.parameters.ground_distance).sum())
+    points = np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=(total, 2))
+    for chunk in point_chunks(plan):
+        points[chunk["point"][0] - 1:chunk["point"][-1]] = chunk["utm"]
+    points.flush()
+    del points
+
+
+def load_points(path):
+    # Memory-mapped (n, 2) easting/northing array written by export_points
+    return np.load(path, mmap_mode="r")
+
+
+_POINT_WRITERS = {
+    "kml": _write_points_kml,
+    "gpx": _write_points_gpx,
+    "csv": _write_points_csv,
+    "npy": _write_points_npy,
+}
+
+
+@diagnostics.timed("export.points")
+def export_points(plan, path, epsg, name="MKE ground points"):
+    """Write the ground points of ``plan`` to ``path``.
+
+    ``epsg`` is the UTM zone the plan was computed in. The format follows the
+    file extension, see :data:`POINT_FORMATS`. Returns the number of points.
+    """
+    _POINT_WRITERS[export_format(path, POINT_FORMATS)](plan, path, epsg, name)
+    return plan.total_points
+
+
+def _sortie_records(sortie, number):
+    # The full flight path first, then every survey line piece of the sortie
+    yield sortie.path, {
+        "sortie": number,
+        "segment": 0,
+        "kind": "path",
+        "length_m": round(sortie.total_km * 1000, 3),
+    }
+    lengths = segment_lengths(sortie.segments)
+    for piece, segment, kind, length in zip(sortie.segments, sortie.order, sortie.kinds, lengths):
+        yield piece, {
+            "sortie": number,
+            "segment": int(segment) + 1,
+            "kind": "main" if kind == MAIN else "cross",
+            "length_m": round(float(length), 3),
+        }
+
+
+def _write_sorties_kml(sorties, path, epsg, name):
+    with open(path, "w", encoding="utf-8") as kml:
+        kml.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n')
+        kml.write(
+            f"<name>{escape(name)}</name>\n{_KML_STYLES}"
+            '<Style id="path"><LineStyle><color>ff00a5ff</color><width>1</width></LineStyle></Style>\n'
+        )
+        for number, sortie in enumerate(sorties, start=1):
+            kml.write(f"<Folder><name>Sortie {number} ({sortie.total_km:.2f} km)</name>\n")
+            placemarks = []
+            for coords, record in _sortie_records(sortie, number):
+                lonlat = transform_coords(coords.reshape(-1, 2), epsg, WGS84)
+                data = "".join(f'<Data name="{key}"><value>{value}</value></Data>' for key, value in record.items())
+                title = "Flight path" if record["kind"] == "path" else f"{record['kind'].title()} {record['segment']}"
+                placemarks.append(
+                    f"<Placemark><name>{title}</name><styleUrl>#{record['kind']}</styleUrl>"
+                    f"<ExtendedData>{data}</ExtendedData><LineString><coordinates>"
+                    + " ".join(f"{lon:.8f},{lat:.8f}" for lon, lat in lonlat)
+                    + "</coordinates></LineString></Placemark>\n"
+                )
+            kml.write("".join(placemarks))
+            kml.write("</Folder>\n")
+        kml.write("</Document>\n</kml>\n")
+
+
+def _write_sorties_gpkg(sorties, path, epsg, name):
+    import fiona
+
+    schema = {
+        "geometry": "LineString",
+        "properties": {"sortie": "int", "segment": "int", "kind": "str", "length_m": "float"},
+    }
+    # Start from an empty file so no layers of an earlier, longer export survive
+    if os.path.exists(path):
+        os.remove(path)
+    for number, sortie in enumerate(sorties, start=1):
+        layer_name = f"sortie_{number}"
+        with fiona.open(path, "w", driver="GPKG", layer=layer_name, crs=f"EPSG:{epsg}", schema=schema) as layer:
+            layer.writerecords(
+                {"geometry": {"type": "LineString", "coordinates": coords.tolist()}, "properties": record}
+                for coords, record in _sortie_records(sortie, number)
+            )
+
+
+_SORTIE_WRITERS = {"kml": _write_sorties_kml, "gpkg": _write_sorties_gpkg}
+
+
+@diagnostics.timed("export.sorties")
+def export_sorties(sorties, path, epsg, name="MKE sorties"):
+    """Write every sortie as its own layer: a KML folder or a GeoPackage layer.
+
+    Each layer holds the sortie's full flight path from take-off to landing
+    and the survey line pieces flown in it. Returns the number of sorties.
+    """
+    _SORTIE_WRITERS[export_format(path, SORTIE_FORMATS)](sorties, path, epsg, name)
+    return len(sorties)
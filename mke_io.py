@@ -0,0 +1,222 @@
+"""KML input and coordinate handling for MKE, shared by the GUI and the batch tools.
+
+KML and KMZ files are read by a small streaming parser rather than GDAL: it
+walks the XML once, keeps only the polygon coordinates, parses them straight
+into NumPy arrays and drops every placemark and style once it has been read,
+so memory stays flat however large the file is. pyproj takes a while to
+import, so it is only imported on the first reprojection; ``preload``
+imports it ahead of time.
+"""
+import functools
+import os
+import re
+import xml.etree.ElementTree as ET
+import zipfile
+from contextlib import contextmanager
+
+import numpy as np
+import shapely
+import utm
+from shapely.geometry import MultiPolygon
+
+from mke_engine import ExclusionLayer
+from mke_profile import diagnostics
+
+WGS84 = 4326
+
+
+def kml_name(path):
+    # File name without its directory and extension
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def utm_epsg(lon, lat):
+    """EPSG code of the WGS84 UTM zone containing ``lon``/``lat``.
+
+    Northern zones are 326xx and southern zones 327xx.
+    """
+    zone_number = utm.latlon_to_zone_number(lat, lon)
+    return (32700 if lat < 0 else 32600) + zone_number
+
+
+def preload():
+    # Import pyproj now instead of on the first reprojection
+    import pyproj  # noqa: F401
+
+
+@functools.lru_cache(maxsize=16)
+def transformer(source_epsg, target_epsg):
+    # Building a Transformer is far more expensive than using one, so one per
+    # CRS pair is kept for every later import and export in the same zone
+    import pyproj
+
+    return pyproj.Transformer.from_crs(source_epsg, target_epsg, always_xy=True)
+
+
+def transform_coords(coords, source_epsg, target_epsg):
+    # Reproject an (n, 2) coordinate array in one call
+    coords = np.asarray(coords, dtype=float)
+    x, y = transformer(source_epsg, target_epsg).transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+
+
+def transform_geometry(geometry, source_epsg, target_epsg):
+    # Reproject every vertex of a geometry, holes included, as one array
+    return shapely.transform(geometry, lambda coords: transform_coords(coords, source_epsg, target_epsg))
+
+
+def parse_coordinates(text):
+    """Parse the text of a KML ``coordinates`` element into an (n, 2) array
+    of lon/lat; altitudes are dropped."""
+    values = text.replace(",", " ").split()
+    if not values:
+        return np.empty((0, 2))
+    # Each tuple has one value more than it has commas. When every tuple has
+    # the same number of values, all of them are converted in one call
+    count = len(values) - text.count(",")
+    if count > 0 and len(values) % count == 0 and len(values) // count in (2, 3):
+        return np.array(values, dtype=float).reshape(count, -1)[:, :2]
+    # Mixed 2D and 3D tuples, or stray commas
+    tuples = re.sub(r"\s*,\s*", ",", text.strip()).split()
+    return np.array([point.split(",")[:2] for point in tuples], dtype=float)
+
+
+@contextmanager
+def _open_kml(path):
+    # A KML file, or the main document of a KMZ archive, as a binary stream
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            documents = [name for name in archive.namelist() if name.lower().endswith(".kml")]
+            if not documents:
+                raise ValueError(f"No KML document found in {path}.")
+            # doc.kml by convention, otherwise the first KML file in the archive
+            with archive.open("doc.kml" if "doc.kml" in documents else documents[0]) as stream:
+                yield stream
+    else:
+        with open(path, "rb") as stream:
+            yield stream
+
+
+# Elements holding features; whatever finishes inside them is dropped once read
+_CONTAINERS = {"kml", "Document", "Folder"}
+
+
+def iter_placemarks(path, parse=True):
+    """Stream the polygon placemarks of a KML or KMZ file.
+
+    Yields ``(name, polygons)`` for every placemark with at least one
+    polygon, in file order and across all folders. ``name`` falls back to
+    "Block n", n counting every placemark. ``polygons`` are lon/lat
+    shapely Polygons with their holes; with ``parse=False`` only their
+    number is known and the list holds None for each.
+    """
+    tags = []
+    parents = []
+    index = 0
+    name, polygons, shell, holes = None, [], None, []
+    try:
+        with _open_kml(path) as stream:
+            for event, element in ET.iterparse(stream, events=("start", "end")):
+                tag = element.tag.rpartition("}")[2]
+                if event == "start":
+                    if tag == "Placemark":
+                        index += 1
+                        name, polygons = None, []
+                    elif tag == "Polygon":
+                        shell, holes = None, []
+                    tags.append(tag)
+                    parents.append(element)
+                    continue
+
+                tags.pop()
+                parents.pop()
+                if tag == "coordinates":
+                    # Only polygon rings: Polygon > outerBoundaryIs/innerBoundaryIs > LinearRing
+                    if parse and tags[-3:-2] == ["Polygon"] and tags[-1] == "LinearRing":
+                        ring = parse_coordinates(element.text or "")
+                        if len(ring) >= 3:
+                            if tags[-2] == "outerBoundaryIs":
+                                shell = ring
+                            elif tags[-2] == "innerBoundaryIs":
+                                holes.append(ring)
+                    element.clear()
+                elif tag == "name" and tags[-1:] == ["Placemark"]:
+                    name = (element.text or "").strip() or None
+                elif tag == "Polygon" and "Placemark" in tags:
+                    if not parse:
+                        polygons.append(None)
+                    elif shell is not None:
+                        polygons.append(shapely.Polygon(shell, holes))
+                elif tag == "Placemark" and polygons:
+                    yield name or f"Block {index}", polygons
+
+                # Nothing of a finished feature or style is needed again
+                if parents and parents[-1].tag.rpartition("}")[2] in _CONTAINERS:
+                    parents[-1].remove(element)
+    except ET.ParseError as e:
+        raise ValueError(f"{path} is not a valid KML file ({e}).") from e
+
+
+def kml_placemark_names(path):
+    # Names of the polygon placemarks in a KML or KMZ file, without reading their coordinates
+    return [name for name, _ in iter_placemarks(path, parse=False)]
+
+
+@diagnostics.timed("kml.read")
+def read_kml_blocks(path, placemark=None, epsg=None):
+    """Read every polygon of every placemark in a KML or KMZ file, holes
+    included, and project them all to the UTM zone of their common centroid,
+    or to ``epsg`` when it is given.
+
+    With ``placemark``, only the placemarks of that name are read.
+    Returns ``(names, polygons_utm, epsg)``, one name and polygon per block.
+    Parts of a multi-polygon placemark become separate blocks.
+    """
+    names = []
+    polygons = []
+    for name, parts in iter_placemarks(path):
+        if placemark is not None and name != placemark:
+            continue
+        parts = [polygon for polygon in parts if not polygon.is_empty]
+        for part_number, polygon in enumerate(parts, start=1):
+            names.append(name if len(parts) == 1 else f"{name} ({part_number})")
+            polygons.append(polygon)
+    if not polygons:
+        if placemark is not None:
+            raise ValueError(f"No polygon placemark named {placemark!r} in {path}.")
+        raise ValueError(f"No polygons found in {path}.")
+
+    # Use the UTM zone of the centroid of all blocks, and project every block in one pass
+    if epsg is None:
+        centroid = MultiPolygon(polygons).centroid
+        epsg = utm_epsg(centroid.x, centroid.y)
+    with diagnostics.timer("kml.reproject"):
+        polygons_utm = list(transform_geometry(np.array(polygons, dtype=object), WGS84, epsg))
+    diagnostics.count("kml_polygons_read", len(polygons))
+    return names, polygons_utm, epsg
+
+
+def as_area(polygons):
+    # One survey area from its blocks: the polygon itself, or a MultiPolygon
+    return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
+
+
+def read_kml_area(path, placemark=None):
+    """Read a KML or KMZ file as one survey area in UTM.
+
+    Returns ``(area_utm, epsg)``; the area is a Polygon for a single block
+    and a MultiPolygon otherwise.
+    """
+    names, polygons, epsg = read_kml_blocks(path, placemark)
+    return as_area(polygons), epsg
+
+
+@diagnostics.timed("kml.exclusions")
+def read_exclusions(paths, epsg):
+    """Read the polygons of one or more KML or KMZ files as an
+    :class:`ExclusionLayer` in ``epsg``, the projection of the survey area.
+    """
+    polygons = []
+    for path in paths:
+        polygons += read_kml_blocks(path, epsg=epsg)[1]
+    return ExclusionLayer(polygons)
@@ -0,0 +1,124 @@
+"""Level of detail for drawing MKE plans.
+
+A plan with 1 m spacing has far more lines and ground points than there are
+pixels on screen. These helpers reduce a plan to what a view can actually
+show: only the lines crossing the view, thinned out to what the screen can
+separate, and the ground points inside it, or a density raster of them when
+there are too many to draw as markers. They work on NumPy arrays only, like the
+planning engine, and never build the plan's full list of ground points.
+"""
+import numpy as np
+
+from mke_engine import point_counts, ranges, segment_lengths
+
+
+def clip_to_view(segments, bounds):
+    """Clip segments to the view rectangle ``bounds`` (xmin, ymin, xmax, ymax).
+
+    Returns the index of every segment crossing the view and the start and
+    end of its visible part as fractions along the segment.
+    """
+    if not len(segments):
+        return np.empty(0, dtype=int), np.empty(0), np.empty(0)
+    start = segments[:, 0]
+    direction = segments[:, 1] - start
+    t_start = np.zeros(len(segments))
+    t_end = np.ones(len(segments))
+    for axis, low, high in ((0, bounds[0], bounds[2]), (1, bounds[1], bounds[3])):
+        delta = direction[:, axis]
+        moving = delta != 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t_low = (low - start[:, axis]) / delta
+            t_high = (high - start[:, axis]) / delta
+        # Segments parallel to this side are either fully in the slab or not at all
+        inside = (start[:, axis] >= low) & (start[:, axis] <= high)
+        enter = np.where(moving, np.minimum(t_low, t_high), np.where(inside, -np.inf, np.inf))
+        leave = np.where(moving, np.maximum(t_low, t_high), np.where(inside, np.inf, -np.inf))
+        t_start = np.maximum(t_start, enter)
+        t_end = np.minimum(t_end, leave)
+    visible = np.flatnonzero(t_start <= t_end)
+    return visible, t_start[visible], t_end[visible]
+
+
+def _pieces(segments, index, t_start, t_end):
+    # The visible parts of the clipped segments as (n, 2, 2)
+    start = segments[index, 0]
+    direction = segments[index, 1] - start
+    return np.stack([start + t_start[:, None] * direction, start + t_end[:, None] * direction], axis=1)
+
+
+def view_lines(segments, bounds, max_lines, line_ids=None):
+    """The visible parts of ``segments``, thinned to every n-th line when
+    more than ``max_lines`` lines cross the view.
+
+    With ``line_ids`` the thinning keeps or drops whole grid lines, so the
+    segments of a line broken up by a concave polygon stay together.
+    """
+    index, t_start, t_end = clip_to_view(segments, bounds)
+    if line_ids is None:
+        rank = np.arange(len(index))
+    else:
+        rank = np.unique(line_ids[index], return_inverse=True)[1]
+    step = max(-(-(int(rank.max()) + 1 if len(rank) else 0) // max(max_lines, 1)), 1)
+    keep = rank % step == 0
+    return _pieces(segments, index[keep], t_start[keep], t_end[keep])
+
+
+def _visible_stations(segments, ground_distance, bounds):
+    # For every segment crossing the view: its index, point count and the
+    # range of its ground points (as in ground_points) that fall in the view
+    index, t_start, t_end = clip_to_view(segments, bounds)
+    counts = point_counts(segments[index], ground_distance)
+    spans = np.maximum(counts - 1, 0)
+    first = np.ceil(t_start * spans - 1e-9).astype(int)
+    last = np.minimum(np.floor(t_end * spans + 1e-9).astype(int), counts - 1)
+    return index, counts, first, np.maximum(last - first + 1, 0), t_start, t_end
+
+
+def visible_point_count(segments, ground_distance, bounds):
+    # Number of ground points inside the view, without building any of them
+    return int(_visible_stations(segments, ground_distance, bounds)[3].sum())
+
+
+def view_points(segments, ground_distance, bounds):
+    """The ground points inside the view as an (n, 2) array, built for the
+    visible stretch of each segment only."""
+    index, counts, first, visible, _, _ = _visible_stations(segments, ground_distance, bounds)
+    owner, offset = ranges(visible)
+    step = first[owner] + offset
+    fraction = step / np.maximum(counts[owner] - 1, 1)
+    start = segments[index[owner], 0]
+    return start + fraction[:, None] * (segments[index[owner], 1] - start)
+
+
+def point_density(segments, ground_distance, bounds, shape, max_samples=2000000):
+    """Ground points per cell over the view, as a (rows, columns) raster.
+
+    Each visible segment is sampled about once per cell and every sample
+    carries its share of the segment's visible points. Should that take more
+    than ``max_samples`` samples, only every n-th segment is sampled, with
+    n times the weight.
+    """
+    index, counts, first, visible, t_start, t_end = _visible_stations(segments, ground_distance, bounds)
+    keep = visible > 0
+    index, visible, t_start, t_end = index[keep], visible[keep], t_start[keep], t_end[keep]
+
+    rows, columns = shape
+    cell = min((bounds[2] - bounds[0]) / columns, (bounds[3] - bounds[1]) / rows)
+    pieces = _pieces(segments, index, t_start, t_end)
+    samples = np.maximum(np.ceil(segment_lengths(pieces) / cell).astype(int), 1)
+    step = max(-(-int(samples.sum()) // max_samples), 1)
+    pieces, visible, samples = pieces[::step], visible[::step], samples[::step]
+
+    owner, offset = ranges(samples)
+    fraction = (offset + 0.5) / samples[owner]
+    coords = pieces[owner, 0] + fraction[:, None] * (pieces[owner, 1] - pieces[owner, 0])
+    weights = step * visible[owner] / samples[owner]
+    density, _, _ = np.histogram2d(
+        coords[:, 1],
+        coords[:, 0],
+        bins=(rows, columns),
+        range=((bounds[1], bounds[3]), (bounds[0], bounds[2])),
+        weights=weights,
+    )
+    return density
@@ -0,0 +1,103 @@
+"""Flight direction search for MKE.
+
+Sweeps the rotation angle through the planning engine and reports the line
+totals for every angle, so the cheapest orientation can be picked without
+retyping angles in the GUI. The sweep fans out over a process pool and never
+touches matplotlib.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+
+import numpy as np
+
+from mke_engine import AreaPipeline, SurveyParameters, exclusion_reach
+from mke_route import route_plan
+
+
+@dataclass(frozen=True)
+class AngleResult:
+    angle: float
+    total_length_km: float
+    # Line km plus turns and transit along the sequenced route
+    flight_length_km: float
+    main_line_count: int
+    cross_line_count: int
+    turn_count: int
+
+
+def _sweep_chunk(polygon, parameters, angles, exclusions=None):
+    # One pipeline per chunk, so the polygon-only stages are computed once
+    pipeline = AreaPipeline()
+    results = []
+    for angle in angles:
+        plan = pipeline.plan(polygon, replace(parameters, angle=float(angle)), exclusions=exclusions)
+        route = route_plan(plan)
+        results.append(
+            AngleResult(
+                angle=float(angle),
+                total_length_km=plan.total_length_km,
+                flight_length_km=route.total_km,
+                main_line_count=plan.main_line_count,
+                cross_line_count=plan.cross_line_count,
+                turn_count=route.turn_count,
+            )
+        )
+    return results
+
+
+# The polygon, parameters and exclusions of the sweep in a worker process,
+# sent once per process rather than with every chunk of angles
+_sweep_area = None
+
+
+def _start_sweep_worker(polygon, parameters, exclusions):
+    global _sweep_area
+    _sweep_area = (polygon, parameters, exclusions)
+
+
+def _sweep_worker_chunk(angles):
+    polygon, parameters, exclusions = _sweep_area
+    return _sweep_chunk(polygon, parameters, angles, exclusions)
+
+
+def sweep_angles(polygon, parameters=None, step=1, start=0, stop=180, workers=None, exclusions=None):
+    """Plan ``polygon`` at every angle in ``[start, stop)`` and return one
+    :class:`AngleResult` per angle, in angle order. The lines are cut by
+    ``exclusions`` at every angle, when given.
+
+    ``workers`` is the number of processes to use; ``None`` uses every CPU and
+    ``1`` runs in this process. The processes are spawned rather than forked,
+    so the sweep can be started from a thread while other threads hold locks.
+    Each process gets the polygon and the exclusions near it once, when it
+    starts.
+    """
+    parameters = parameters or SurveyParameters()
+    parameters.validate()
+    if step <= 0:
+        raise ValueError("Angle step must be greater than zero.")
+
+    angles = np.arange(start, stop, step)
+    workers = min(workers or os.cpu_count() or 1, len(angles))
+    if workers <= 1:
+        return _sweep_chunk(polygon, parameters, angles, exclusions)
+
+    # A few chunks per worker keeps the pool busy when some angles are slower
+    chunks = np.array_split(angles, workers * 4)
+    chunks = [chunk for chunk in chunks if len(chunk)]
+    if exclusions is not None:
+        exclusions = exclusions.around(exclusion_reach(polygon, parameters.margin))
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_start_sweep_worker,
+        initargs=(polygon, parameters, exclusions),
+    ) as executor:
+        chunk_results = executor.map(_sweep_worker_chunk, chunks)
+        return [result for results in chunk_results for result in results]
+
+
+def best_angle(results):
+    # Cheapest orientation by flown km, turns and transit included, fewer turns breaking ties
+    return min(results, key=lambda result: (round(result.flight_length_km, 6), result.turn_count))
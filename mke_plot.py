@@ -0,0 +1,201 @@
+"""The plot window of MKE.
+
+Kept out of MKE_GUI_V3 so matplotlib is only imported once the first plan is
+drawn, or by the background warm-up after the main window appears.
+"""
+import numpy as np
+import shapely
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties
+from PyQt5.QtCore import QTimer
+from PyQt5.QtWidgets import QMainWindow, QVBoxLayout, QWidget
+
+from mke_engine import survey_blocks
+from mke_lod import point_density, view_lines, view_points, visible_point_count
+from mke_profile import diagnostics
+
+# More ground points than this in view are drawn as a density raster instead of markers
+MAX_POINT_MARKERS = 20000
+# Size of a density raster cell in screen pixels
+DENSITY_CELL_PIXELS = 4
+# Screen pixels per drawn line once there are more lines than the view can separate
+LINE_PIXELS = 8
+
+
+def _outline(polygons):
+    # Every ring of ``polygons`` as one (n, 2) array, rings separated by NaN
+    coords, ring_index = shapely.get_coordinates(shapely.get_rings(polygons), return_index=True)
+    breaks = np.flatnonzero(np.diff(ring_index)) + 1
+    return np.insert(coords, breaks, np.nan, axis=0)
+
+class PlotWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("Plot Window")
+        self.setGeometry(200, 200, 600, 400)
+        self.plot_widget = QWidget(self)
+        self.setCentralWidget(self.plot_widget)
+        # A bare Figure; pyplot is never needed and takes long to import
+        self.figure = Figure()
+        self.ax = self.figure.add_subplot()
+        self.canvas = FigureCanvas(self.figure)
+        self.font = FontProperties(family='Times New Roman', size=12)
+        self.polygon = None
+        self.plan = None
+        # The (polygon, exclusion layer) whose exclusions are outlined
+        self.shown_exclusions = None
+        self.show_points = False
+        self.detail_key = None
+        self.setup_plot()
+        self.setup_layers()
+
+    def setup_plot(self):
+        plot_layout = QVBoxLayout(self.plot_widget)
+        plot_layout.addWidget(NavigationToolbar(self.canvas, self))
+        plot_layout.addWidget(self.canvas)
+
+        # Zooming, panning and resizing reload the detail for the new view,
+        # once the view has settled
+        self.detail_timer = QTimer(self)
+        self.detail_timer.setSingleShot(True)
+        self.detail_timer.setInterval(50)
+        self.detail_timer.timeout.connect(self.refresh_view)
+        self.ax.callbacks.connect("xlim_changed", lambda ax: self.detail_timer.start())
+        self.ax.callbacks.connect("ylim_changed", lambda ax: self.detail_timer.start())
+        self.canvas.mpl_connect("resize_event", lambda event: self.detail_timer.start())
+
+    def setup_layers(self):
+        # One artist per layer, created once and updated in place on every redraw
+        ax = self.ax
+        ax.ticklabel_format(style='plain', useOffset=False)
+        ax.set_aspect('equal')
+        self.polygon_layer, = ax.plot([], [], label="Original Polygon")
+        self.exclusion_layer, = ax.plot([], [], color="red", linewidth=0.8, label="Exclusions")
+        self.main_layer = ax.add_collection(LineCollection([], colors="blue", label="Main Lines"))
+        self.cross_layer = ax.add_collection(LineCollection([], colors="purple", label="Cross Lines"))
+        self.points_layer, = ax.plot([], [], 'o', linestyle='None', color='green', label="Ground Points")
+        self.density_layer = ax.imshow(
+            np.zeros((1, 1)), extent=(0, 1, 0, 1), origin="lower", cmap="Greens", interpolation="nearest"
+        )
+        self.density_layer.set_visible(False)
+        ax.legend(handles=[self.main_layer, self.cross_layer], prop=self.font, loc="upper right")
+
+    def draw_plan(self, polygon, plan, title, exclusions=None):
+        self.plan = plan
+        self.show_points = True
+        self.ax.set_title(title, fontproperties=self.font)
+        self.show_polygon(polygon, plan)
+        self.show_exclusions(polygon, exclusions)
+        self.update_detail()
+
+        # Refresh the canvas and display the plot
+        self.draw()
+        self.show()
+
+    def draw_preview(self, polygon, plan, title, exclusions=None):
+        # The lines without ground points, quick to draw while the full plot is prepared
+        self.plan = plan
+        self.show_points = False
+        self.ax.set_title(f"{title} (preview)", fontproperties=self.font)
+        self.show_polygon(polygon, plan)
+        self.show_exclusions(polygon, exclusions)
+        self.update_detail()
+        self.draw()
+        self.show()
+
+    def draw(self):
+        with diagnostics.timer("render.draw"):
+            self.canvas.draw()
+
+    def refresh_view(self):
+        # Already debounced by detail_timer, so draw straight away
+        if self.update_detail():
+            self.draw()
+
+    def update_detail(self):
+        with diagnostics.timer("render.detail"):
+            return self._update_detail()
+
+    def _update_detail(self):
+        # Show only what the current view can resolve: the lines crossing it,
+        # a few pixels apart, and its ground points as markers, or as a
+        # density raster when there are too many. Returns whether anything changed.
+        plan = self.plan
+        if plan is None:
+            return False
+        (x_min, x_max), (y_min, y_max) = self.ax.get_xlim(), self.ax.get_ylim()
+        bounds = (x_min, y_min, x_max, y_max)
+        width, height = max(int(self.ax.bbox.width), 1), max(int(self.ax.bbox.height), 1)
+        key = (id(plan), self.show_points, bounds, width, height)
+        if key == self.detail_key:
+            return False
+        self.detail_key = key
+
+        max_lines = max(width, height) // LINE_PIXELS
+        main_lines = view_lines(plan.main_lines, bounds, max_lines, plan.main_line_ids)
+        cross_lines = view_lines(plan.cross_lines, bounds, max_lines, plan.cross_line_ids)
+        self.main_layer.set_segments(main_lines)
+        self.cross_layer.set_segments(cross_lines)
+        diagnostics.count("lines_drawn", len(main_lines) + len(cross_lines))
+
+        self.points_layer.set_data([], [])
+        self.density_layer.set_visible(False)
+        if not self.show_points:
+            return True
+        ground_distance = plan.parameters.ground_distance
+        # Markers only while neighbouring points are a few pixels apart
+        spacing = min(ground_distance, plan.parameters.line_spacing) * width / (x_max - x_min)
+        if (
+            spacing >= DENSITY_CELL_PIXELS
+            and visible_point_count(plan.main_lines, ground_distance, bounds) <= MAX_POINT_MARKERS
+        ):
+            points = view_points(plan.main_lines, ground_distance, bounds)
+            self.points_layer.set_data(points[:, 0], points[:, 1])
+            self.points_layer.set_markersize(min(6, spacing / 2))
+            diagnostics.count("markers_drawn", len(points))
+        else:
+            shape = (max(height // DENSITY_CELL_PIXELS, 1), max(width // DENSITY_CELL_PIXELS, 1))
+            density = point_density(plan.main_lines, ground_distance, bounds, shape)
+            self.density_layer.set_data(np.ma.masked_equal(density, 0))
+            self.density_layer.set_extent((x_min, x_max, y_min, y_max))
+            self.density_layer.set_clim(0, max(density.max(), 1))
+            self.density_layer.set_visible(True)
+            diagnostics.count("density_rasters")
+        return True
+
+    def show_polygon(self, polygon, plan):
+        # Only a new polygon moves the view, parameter changes keep it as it is
+        if polygon is not self.polygon:
+            self.polygon = polygon
+
+            # Outline every block and hole in one artist
+            outline = _outline(survey_blocks(polygon))
+            self.polygon_layer.set_data(outline[:, 0], outline[:, 1])
+            # Drop the old plan's detail so only the new polygon and plan set the limits
+            self.exclusion_layer.set_data([], [])
+            self.main_layer.set_segments([])
+            self.cross_layer.set_segments([])
+            self.points_layer.set_data([], [])
+            self.density_layer.set_visible(False)
+            self.ax.relim(visible_only=True)
+            self.ax.update_datalim(np.concatenate([plan.main_lines, plan.cross_lines]).reshape(-1, 2))
+            self.ax.autoscale_view()
+
+            # Apply font to tick labels
+            for label in self.ax.get_xticklabels() + self.ax.get_yticklabels():
+                label.set_fontproperties(self.font)
+
+    def show_exclusions(self, polygon, exclusions):
+        # Outline the exclusions near the survey area; they never move the view
+        shown = self.shown_exclusions
+        if shown is not None and shown[0] is polygon and shown[1] is exclusions:
+            return
+        self.shown_exclusions = (polygon, exclusions)
+        if exclusions is None:
+            self.exclusion_layer.set_data([], [])
+            return
+        outline = _outline(exclusions.near(shapely.box(*polygon.bounds)))
+        self.exclusion_layer.set_data(outline[:, 0], outline[:, 1])
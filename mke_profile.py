@@ -0,0 +1,149 @@
+"""Timing and counters for MKE.
+
+Every module reports into the shared :data:`diagnostics` object: how long
+each stage took and how often it ran (KML reading, reprojection, every
+planning stage, routing, rendering, export), a few counters (GEOS calls,
+geometries created, segments clipped, artists drawn) and the peak memory.
+The GUI shows them in its diagnostics window and the batch CLI writes them
+as JSON. Timing costs two clock reads per stage, so it is always on; memory
+tracing is opt-in because tracemalloc slows every allocation down.
+
+``profiled(path)`` runs a block under cProfile and dumps the statistics to
+``path``, for a look with ``python -m pstats`` or snakeviz.
+"""
+import cProfile
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+class Diagnostics:
+    """Thread-safe stage timers and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def reset(self):
+        with self._lock:
+            self.timers = {}
+            self.counters = {}
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    @contextmanager
+    def timer(self, name):
+        # Time the block under ``name``; nested timers each count their own time in full
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        # Decorator form of ``timer``
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def record(self, name, seconds):
+        # Add a duration measured elsewhere, such as the time to the first window
+        with self._lock:
+            calls, total, last = self.timers.get(name, (0, 0.0, 0.0))
+            self.timers[name] = (calls + 1, total + seconds, seconds)
+
+    def merge(self, snapshot):
+        # Add the timers and counters of a snapshot taken elsewhere, such as in a worker process
+        with self._lock:
+            for name, timer in snapshot["timers"].items():
+                calls, total, _ = self.timers.get(name, (0, 0.0, 0.0))
+                self.timers[name] = (calls + timer["calls"], total + timer["seconds"], timer["last_seconds"])
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + int(amount)
+
+    def trace_memory(self, enabled=True):
+        # Track the Python and NumPy peak with tracemalloc instead of the process peak
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif not enabled and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def peak_memory(self):
+        """Peak memory in bytes: the traced peak since the last reset while
+        tracing, otherwise the process peak, or None where neither is known."""
+        if tracemalloc.is_tracing():
+            return tracemalloc.get_traced_memory()[1]
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    def snapshot(self):
+        # Plain, JSON-ready copy of everything measured so far
+        with self._lock:
+            timers = {
+                name: {"calls": calls, "seconds": round(seconds, 6), "last_seconds": round(last, 6)}
+                for name, (calls, seconds, last) in sorted(self.timers.items())
+            }
+            counters = dict(sorted(self.counters.items()))
+        return {
+            "timers": timers,
+            "counters": counters,
+            "peak_memory_bytes": self.peak_memory(),
+            "memory_traced": tracemalloc.is_tracing(),
+        }
+
+
+def merge_snapshots(snapshots):
+    # Sum timers and counters of several snapshots, keeping the highest peak memory
+    timers, counters, peaks = {}, {}, []
+    for snapshot in snapshots:
+        for name, timer in snapshot["timers"].items():
+            total = timers.setdefault(name, {"calls": 0, "seconds": 0.0})
+            total["calls"] += timer["calls"]
+            total["seconds"] = round(total["seconds"] + timer["seconds"], 6)
+        for name, value in snapshot["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        if snapshot["peak_memory_bytes"] is not None:
+            peaks.append(snapshot["peak_memory_bytes"])
+    return {
+        "timers": dict(sorted(timers.items())),
+        "counters": dict(sorted(counters.items())),
+        "peak_memory_bytes": max(peaks) if peaks else None,
+    }
+
+
+@contextmanager
+def profiled(path):
+    # Run the block under cProfile and dump the statistics to ``path``
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+# The diagnostics every MKE module reports into
+diagnostics = Diagnostics()
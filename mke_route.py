@@ -0,0 +1,170 @@
+"""Flight route sequencing for MKE.
+
+Orders the clipped segments of a plan into one flyable path: the main lines
+of each block are flown back and forth (boustrophedon), then its cross lines,
+then the next block. Each line is entered from whichever end is nearer to
+where the aircraft is, so concave blocks with several segments per line
+are still flown without doubling back.
+
+The connections between consecutive segments are counted as well:
+
+* turns  - from the end of one line to the start of the next line of the
+  same pattern
+* ferry  - everything else: gaps along a line, main to cross lines, block to
+  block
+
+Connections are measured as straight legs; turn radius and climb are left to
+the flight planner.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from mke_engine import segment_lengths
+from mke_profile import diagnostics
+
+MAIN = 0
+CROSS = 1
+
+
+@dataclass
+class FlightRoute:
+    # Segments in flight order, each oriented in the direction it is flown
+    segments: np.ndarray
+    # Position of every flown segment in the plan, main lines first, then cross lines
+    order: np.ndarray
+    # MAIN or CROSS for every flown segment
+    kinds: np.ndarray
+    # Legs from the end of each segment to the start of the next, (n - 1, 2, 2)
+    connectors: np.ndarray
+    # True for the connectors that are turns, False for ferry legs
+    turns: np.ndarray
+    line_km: float = 0.0
+    turn_km: float = 0.0
+    ferry_km: float = 0.0
+
+    @property
+    def total_km(self):
+        return self.line_km + self.turn_km + self.ferry_km
+
+    @property
+    def turn_count(self):
+        return int(self.turns.sum())
+
+
+def _line_starts(line_ids):
+    # Index of the first segment of every run of equal line ids
+    if not len(line_ids):
+        return np.empty(0, dtype=int)
+    return np.flatnonzero(np.r_[True, line_ids[1:] != line_ids[:-1]])
+
+
+def sequence_lines(segments, line_ids, position=None):
+    """Order one pattern of parallel lines as a back-and-forth path.
+
+    ``segments`` are grouped by line and sorted along it, as the planning
+    engine produces them. The pattern is entered from whichever outer line
+    is nearer to ``position`` (the first line when ``position`` is None) and
+    every next line from its nearer end.
+
+    Returns the segment indices in flight order and whether each one is
+    flown backwards.
+    """
+    count = len(segments)
+    if not count:
+        return np.empty(0, dtype=int), np.empty(0, dtype=bool)
+
+    starts = _line_starts(line_ids)
+    stops = np.r_[starts[1:], count]
+    line_start = segments[starts, 0]
+    line_end = segments[stops - 1, 1]
+
+    lines = np.arange(len(starts))
+    if position is not None:
+        # Enter from the outer line nearest to where the aircraft is
+        first = min(np.hypot(*(line_start[0] - position)), np.hypot(*(line_end[0] - position)))
+        last = min(np.hypot(*(line_start[-1] - position)), np.hypot(*(line_end[-1] - position)))
+        if last < first:
+            lines = lines[::-1]
+
+    # Only one decision per line depends on the previous one, so this loop
+    # runs over lines with plain floats and everything else stays in arrays
+    start_x, start_y = line_start[lines].T.tolist()
+    end_x, end_y = line_end[lines].T.tolist()
+    if position is None:
+        x, y = start_x[0], start_y[0]
+    else:
+        x, y = float(position[0]), float(position[1])
+    backwards = np.empty(len(lines), dtype=bool)
+    for index in range(len(lines)):
+        backward = (end_x[index] - x) ** 2 + (end_y[index] - y) ** 2 < (start_x[index] - x) ** 2 + (
+            start_y[index] - y
+        ) ** 2
+        backwards[index] = backward
+        x, y = (start_x[index], start_y[index]) if backward else (end_x[index], end_y[index])
+
+    # Expand the per-line decisions to the segments, reversing backward lines
+    first_index, last_index = starts[lines], stops[lines] - 1
+    sizes = last_index - first_index + 1
+    owner = np.repeat(np.arange(len(lines)), sizes)
+    offset = np.arange(count) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    order = np.where(backwards[owner], last_index[owner] - offset, first_index[owner] + offset)
+    return order, backwards[owner]
+
+
+def _block_route(plan, position, segment_offset, cross_offset):
+    # Main lines then cross lines of one block, each pattern entered near the aircraft
+    legs = []
+    for kind, lines, line_ids, offset in (
+        (MAIN, plan.main_lines, plan.main_line_ids, segment_offset),
+        (CROSS, plan.cross_lines, plan.cross_line_ids, cross_offset),
+    ):
+        order, backwards = sequence_lines(lines, line_ids, position)
+        if not len(order):
+            continue
+        flown = lines[order]
+        flown[backwards] = flown[backwards, ::-1]
+        legs.append((kind, flown, order + offset, line_ids[order]))
+        position = flown[-1, 1]
+    return legs, position
+
+
+@diagnostics.timed("route")
+def route_plan(plan):
+    """Sequence every segment of ``plan`` into a :class:`FlightRoute`.
+
+    Blocks of a combined plan are flown one after the other in block order.
+    """
+    blocks = plan.blocks or [plan]
+    legs, position = [], None
+    main_offset, cross_offset = 0, len(plan.main_lines)
+    for block in blocks:
+        block_legs, position = _block_route(block, position, main_offset, cross_offset)
+        legs.extend(block_legs)
+        main_offset += len(block.main_lines)
+        cross_offset += len(block.cross_lines)
+
+    if not legs:
+        empty = np.empty((0, 2, 2))
+        return FlightRoute(empty, np.empty(0, dtype=int), np.empty(0, dtype=int), empty, np.empty(0, dtype=bool))
+
+    segments = np.concatenate([flown for _, flown, _, _ in legs])
+    order = np.concatenate([indices for _, _, indices, _ in legs])
+    kinds = np.concatenate([np.full(len(flown), kind) for kind, flown, _, _ in legs])
+    # Which pattern run every segment belongs to, so pattern changes are never turns
+    run = np.concatenate([np.full(len(flown), index) for index, (_, flown, _, _) in enumerate(legs)])
+    line_ids = np.concatenate([ids for _, _, _, ids in legs])
+
+    connectors = np.stack([segments[:-1, 1], segments[1:, 0]], axis=1)
+    turns = (run[1:] == run[:-1]) & (line_ids[1:] != line_ids[:-1])
+    connector_lengths = segment_lengths(connectors)
+    return FlightRoute(
+        segments=segments,
+        order=order,
+        kinds=kinds,
+        connectors=connectors,
+        turns=turns,
+        line_km=float(segment_lengths(segments).sum()) / 1000,
+        turn_km=float(connector_lengths[turns].sum()) / 1000,
+        ferry_km=float(connector_lengths[~turns].sum()) / 1000,
+    )
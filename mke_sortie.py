@@ -0,0 +1,136 @@
+"""Sortie partitioning for MKE.
+
+Cuts a sequenced flight route into sorties that each fit one battery or fuel
+load. Every sortie takes off from the same point, flies out to where the
+previous one stopped, follows the route as far as the endurance allows while
+keeping enough range to fly straight back, and lands. Lines too long for one
+sortie are split where the aircraft has to turn home.
+
+Flying along the route never brings the aircraft closer to home faster than
+it flies, so "route flown so far + distance home" only grows along the route.
+That lets every sortie end be found with a binary search over the route's
+vertices plus one closed-form step inside the last line, instead of trying
+segments one by one.
+"""
+from dataclasses import dataclass
+
+import numpy as np
+
+from mke_engine import segment_lengths
+from mke_profile import diagnostics
+
+
+@dataclass
+class Sortie:
+    # Survey line pieces flown in this sortie, in flight order, as (n, 2, 2)
+    segments: np.ndarray
+    # Position of each piece's segment in the plan, main lines first, then cross lines
+    order: np.ndarray
+    # MAIN or CROSS for every piece, see mke_route
+    kinds: np.ndarray
+    # Complete flight path from take-off back to landing, as (m, 2) points
+    path: np.ndarray
+    line_km: float = 0.0
+    total_km: float = 0.0
+
+
+def _route_path(route):
+    # The route as a polyline: segment starts and ends alternate, so even legs
+    # are survey lines and odd legs are the turns and ferries between them
+    vertices = route.segments.reshape(-1, 2)
+    distance = np.r_[0.0, np.cumsum(np.hypot(*np.diff(vertices, axis=0).T))]
+    return vertices, distance
+
+
+def _point_at(vertices, distance, position):
+    # Coordinates of the points ``position`` metres along the polyline
+    leg = np.clip(np.searchsorted(distance, position, side="right") - 1, 0, len(vertices) - 2)
+    length = distance[leg + 1] - distance[leg]
+    fraction = np.divide(position - distance[leg], length, out=np.zeros_like(length), where=length > 0)
+    return vertices[leg] + fraction[..., None] * (vertices[leg + 1] - vertices[leg])
+
+
+@diagnostics.timed("sorties")
+def plan_sorties(route, endurance_km, takeoff):
+    """Partition ``route`` into sorties of at most ``endurance_km`` each.
+
+    ``takeoff`` is the (x, y) take-off and landing point in the route's
+    projected coordinates. Sorties only ever end on a survey line, never
+    halfway through a turn. Returns a list of :class:`Sortie`.
+    """
+    if endurance_km <= 0:
+        raise ValueError("Endurance must be greater than zero.")
+    if not len(route.segments):
+        return []
+
+    endurance = endurance_km * 1000
+    takeoff = np.asarray(takeoff, dtype=float)
+    vertices, distance = _route_path(route)
+    line_starts, line_ends = distance[0::2], distance[1::2]
+    # Route flown up to each vertex plus the way home from there, never decreasing
+    reach = np.maximum.accumulate(distance + np.hypot(*(vertices - takeoff).T))
+    last = len(vertices) - 1
+
+    sorties = []
+    start = 0.0
+    while True:
+        start_point = _point_at(vertices, distance, start)
+        # The farthest vertex that still leaves range to get home
+        budget = endurance - np.hypot(*(start_point - takeoff)) + start
+        vertex = np.searchsorted(reach, budget, side="right") - 1
+        if vertex < 0:
+            # Not even the start of the route is in range
+            end = start
+        elif vertex >= last:
+            end = distance[last]
+        elif vertex % 2:
+            # Stop at the end of the line instead of partway through a turn
+            end = distance[vertex]
+        else:
+            # Part of the way along this line: solve along + home == budget
+            leg = vertices[vertex + 1] - vertices[vertex]
+            length = distance[vertex + 1] - distance[vertex]
+            offset = vertices[vertex] - takeoff
+            along = offset @ leg / length if length else 0.0
+            remaining = budget - distance[vertex]
+            step = (remaining**2 - offset @ offset) / (2 * (along + remaining)) if along + remaining > 0 else 0.0
+            end = distance[vertex] + min(max(step, 0.0), length)
+        if end <= start + 1e-6:
+            raise ValueError(
+                f"An endurance of {endurance_km:g} km is too short to survey from the take-off point and return."
+            )
+
+        sorties.append(_sortie(route, vertices, distance, start, end, takeoff))
+
+        # The next sortie picks up where this one stopped, skipping any turn
+        following = np.searchsorted(line_ends, end, side="right")
+        if following >= len(line_ends) or end >= distance[last]:
+            return sorties
+        start = max(end, line_starts[following])
+
+
+def _sortie(route, vertices, distance, start, end, takeoff):
+    # Survey pieces and flight path between ``start`` and ``end`` metres along the route
+    line_starts, line_ends = distance[0::2], distance[1::2]
+    first = np.searchsorted(line_ends, start, side="right")
+    stop = np.searchsorted(line_starts, end, side="left")
+    piece_start = np.maximum(line_starts[first:stop], start)
+    piece_end = np.minimum(line_ends[first:stop], end)
+    pieces = np.stack(
+        [_point_at(vertices, distance, piece_start), _point_at(vertices, distance, piece_end)], axis=1
+    )
+
+    # Take-off, the route from start to end with every vertex in between, landing
+    inner = vertices[np.searchsorted(distance, start, side="right"):np.searchsorted(distance, end, side="left")]
+    path = np.concatenate(
+        [takeoff[None], _point_at(vertices, distance, np.array([start])), inner,
+         _point_at(vertices, distance, np.array([end])), takeoff[None]]
+    )
+    return Sortie(
+        segments=pieces,
+        order=route.order[first:stop],
+        kinds=route.kinds[first:stop],
+        path=path,
+        line_km=float(segment_lengths(pieces).sum()) / 1000,
+        total_km=float(np.hypot(*np.diff(path, axis=0).T).sum()) / 1000,
+    )